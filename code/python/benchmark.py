@@ -0,0 +1,189 @@
+# --- Header -------------------------------------------------------------------
+# Scaling benchmark of the pipeline stages on synthetic Worldscope panels
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+from do_analysis import (
+    build_em_panel, calculate_aggregate, calculate_em1, calculate_em2, calculate_em3, calculate_em4,
+    create_final_combined_table
+)
+from prepare_data import filter_countries, filter_firms
+from storage import read_table
+from synthetic import write_panel
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+# Columns of a stage measurement, as saved in the results and the baseline
+STAGE_COLUMNS = ['size', 'stage', 'rows_in', 'rows_out', 'wall_s', 'rows_per_s', 'peak_mb', 'result_hash']
+
+
+def main():
+    '''
+    Runs every pipeline stage on synthetic panels of the configured sizes.
+
+    Records the wall time, the peak memory and the rows per second of each stage,
+    compares them and a fingerprint of the stage result with the saved baseline and
+    exits with an error if a stage regressed.
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic panels.')
+    parser.add_argument('--sizes', type=int, nargs='+', help='Panel sizes in rows, instead of the configured sizes.')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline.')
+    args = parser.parse_args()
+
+    log.info("Running benchmark ...")
+    cfg = read_config('config/benchmark_cfg.yaml')
+    pull_cfg = read_config('config/pull_data_cfg.yaml')
+    prepare_cfg = read_config('config/prepare_data_cfg.yaml')
+    analysis_cfg = read_config('config/do_analysis_cfg.yaml')
+
+    os.makedirs(cfg['synthetic_dir'], exist_ok=True)
+    results = []
+    for size in args.sizes or cfg['sizes']:
+        path = os.path.join(cfg['synthetic_dir'], f"synthetic_{size}_{cfg['seed']}.parquet")
+        if not os.path.exists(path):
+            log.info(f"Generating synthetic panel with {size} rows ...")
+            write_panel(path, size, seed=cfg['seed'], countries=pull_cfg['included_countries'])
+        log.info(f"Benchmarking {size} rows ...")
+        for row in run_stages(path, pipeline_stages(prepare_cfg, analysis_cfg), cfg['repeats']):
+            results.append({'size': size, **row})
+    results = pd.DataFrame(results)
+
+    baseline = None
+    if os.path.exists(cfg['benchmark_baseline']):
+        with open(cfg['benchmark_baseline']) as f:
+            baseline = pd.DataFrame(json.load(f))
+    results = compare_to_baseline(results, baseline, cfg)
+    log.info(f"Benchmark results:\n{results.to_string(index=False)}")
+
+    with open(cfg['benchmark_results'], 'w') as f:
+        json.dump(results.to_dict(orient='records'), f, indent=2)
+    log.info(f"Benchmark results saved to {cfg['benchmark_results']}")
+    if args.save_baseline:
+        with open(cfg['benchmark_baseline'], 'w') as f:
+            json.dump(results[STAGE_COLUMNS].to_dict(orient='records'), f, indent=2)
+        log.info(f"Baseline saved to {cfg['benchmark_baseline']}")
+
+    regressions = results[results['regression'] != '']
+    if not regressions.empty and not args.save_baseline:
+        log.error(f"{len(regressions)} stages regressed against the baseline")
+        sys.exit(1)
+    log.info("Running benchmark ... Done!")
+
+
+def pipeline_stages(prepare_cfg, analysis_cfg):
+    '''
+    Returns the pipeline stages in order as (name, inputs, output, function).
+
+    Each stage reads its inputs from the results of earlier stages and stores its result
+    under output. The thresholds come from the prepare and analysis configs.
+    '''
+    key_vars = prepare_cfg['key_vars']
+    return [
+        ('read_table', ['path'], 'pulled', read_table),
+        ('drop_duplicates', ['pulled'], 'deduplicated',
+         lambda df: df.drop_duplicates(subset=['item6105', 'year_'], keep='first')),
+        ('filter_countries', ['deduplicated'], 'countries',
+         lambda df: filter_countries(df, key_vars, prepare_cfg['min_country_obs'])[0]),
+        ('filter_firms', ['countries'], 'prepared',
+         lambda df: filter_firms(
+             df, key_vars, prepare_cfg['min_consecutive_years'], prepare_cfg['consecutive_years_rule']
+         )),
+        ('build_em_panel', ['prepared'], 'em_panel', build_em_panel),
+        ('calculate_em1', ['em_panel'], 'em1', lambda df: calculate_em1(df)[0]),
+        ('calculate_em2', ['em_panel'], 'em2', lambda df: calculate_em2(df)[0]),
+        ('calculate_em3', ['em_panel'], 'em3', lambda df: calculate_em3(df)[0]),
+        ('calculate_em4', ['em_panel'], 'em4', lambda df: calculate_em4(
+            df, analysis_cfg['em4_profit_band'], analysis_cfg['em4_min_small_losses']
+        )[0]),
+        ('calculate_aggregate', ['em1', 'em2', 'em3', 'em4'], 'final_table', calculate_aggregate),
+        ('create_final_combined_table', ['final_table'], 'final_combined_table', create_final_combined_table),
+    ]
+
+
+def run_stages(path, stages, repeats=3):
+    '''
+    Runs the stages on the panel stored at path and measures each of them.
+
+    Every stage runs repeats times for the wall time and once more under tracemalloc for
+    the peak memory, so tracing does not slow down the timed runs. Returns one dict per stage.
+    '''
+    state = {'path': path}
+    rows = []
+    for stage, inputs, output, function in stages:
+        args = [state[name] for name in inputs]
+        wall_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = function(*args)
+            wall_times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        state[output] = result
+        wall = min(wall_times)
+        rows_in = len(args[0]) if not isinstance(args[0], str) else len(result)
+        rows.append({
+            'stage': stage,
+            'rows_in': rows_in,
+            'rows_out': len(result),
+            'wall_s': wall,
+            'rows_per_s': rows_in / wall if wall > 0 else float('inf'),
+            'peak_mb': peak / 2**20,
+            'result_hash': result_fingerprint(result),
+        })
+    return rows
+
+
+def result_fingerprint(result):
+    '''
+    Returns a short hash of the values of a stage result, independent of its index.
+    '''
+    hashes = pd.util.hash_pandas_object(result, index=False).to_numpy()
+    return hashlib.sha256(hashes.tobytes()).hexdigest()[:16]
+
+
+def compare_to_baseline(results, baseline, cfg):
+    '''
+    Adds the baseline measurements and a regression flag to the results.
+
+    A stage regressed if it is slower than the baseline by more than time_tolerance and
+    min_time_difference, if its peak memory grew by more than memory_tolerance, or if its
+    result differs from the baseline result. Stages without a baseline are not flagged.
+    '''
+    if baseline is None:
+        results['regression'] = ''
+        return results
+
+    baseline = baseline[['size', 'stage', 'wall_s', 'peak_mb', 'result_hash']].rename(
+        columns={'wall_s': 'baseline_wall_s', 'peak_mb': 'baseline_peak_mb', 'result_hash': 'baseline_hash'}
+    )
+    results = results.merge(baseline, on=['size', 'stage'], how='left')
+    has_baseline = results['baseline_hash'].notna()
+    slower = (
+        (results['wall_s'] > results['baseline_wall_s'] * (1 + cfg['time_tolerance']))
+        & (results['wall_s'] - results['baseline_wall_s'] > cfg['min_time_difference'])
+    )
+    more_memory = results['peak_mb'] > results['baseline_peak_mb'] * (1 + cfg['memory_tolerance'])
+    result_changed = has_baseline & (results['result_hash'] != results['baseline_hash'])
+
+    flags = pd.DataFrame({'slower': slower, 'more_memory': more_memory, 'result_changed': result_changed})
+    results['regression'] = flags.apply(lambda row: ', '.join(row.index[row]), axis=1)
+    return results.drop(columns='baseline_hash')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# --- Header -------------------------------------------------------------------
+# Firm-cluster bootstrap of the country EM scores, ranks and aggregate score
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+EM_METRICS = ['EM1', 'EM2', 'EM3', 'EM4']
+
+# Rank direction of each metric, as in calculate_aggregate: higher EM1 and EM2 scores
+# indicate less earnings management, higher EM3 and EM4 scores indicate more.
+RANK_ASCENDING = {'EM1': False, 'EM2': False, 'EM3': True, 'EM4': True}
+
+# Contributions shared with the worker processes, set once per worker by the pool initializer
+_worker_contributions = None
+
+
+def build_contributions(em_values):
+    '''
+    Precomputes the firm-level contributions of each country to EM1-EM4.
+
+    Expects the firm-year values from firm_year_em_values in do_analysis: EM1, EM3,
+    scaled_delta_Accruals, scaled_delta_CFO and the small_profits and small_losses
+    masks. Resampling a firm only changes how often its firm-years enter the
+    country statistics, so the firm-year values are computed once and each
+    replicate only draws firm weights.
+
+    Returns the list of countries and a list with one dict of arrays per country.
+    '''
+    countries = []
+    contributions = []
+    for country, data in em_values.groupby('item6026', observed=True, sort=True):
+        firms, firm_index = np.unique(data['item6105'].to_numpy(dtype=str), return_inverse=True)
+        country_contribution = {'n_firms': len(firms)}
+
+        # EM1 and EM3 are country medians of firm-year values: keep the values sorted with their firm
+        for metric in ['EM1', 'EM3']:
+            values = data[metric].to_numpy(dtype=np.float64)
+            keep = ~np.isnan(values)
+            order = np.argsort(values[keep], kind='stable')
+            country_contribution[metric] = (values[keep][order], firm_index[keep][order])
+
+        # EM2 is a Spearman correlation of firm-year pairs: keep the rank order and tie groups of both variables
+        x = data['scaled_delta_Accruals'].to_numpy(dtype=np.float64)
+        y = data['scaled_delta_CFO'].to_numpy(dtype=np.float64)
+        keep = np.isfinite(x) & np.isfinite(y)
+        country_contribution['EM2'] = (
+            firm_index[keep], sorted_ties(x[keep]), sorted_ties(y[keep])
+        )
+
+        # EM4 is a ratio of counts: keep the number of small profits and small losses per firm
+        country_contribution['small_profits'] = np.bincount(
+            firm_index, weights=data['small_profits'].to_numpy(dtype=np.float64), minlength=len(firms)
+        )
+        country_contribution['small_losses'] = np.bincount(
+            firm_index, weights=data['small_losses'].to_numpy(dtype=np.float64), minlength=len(firms)
+        )
+
+        countries.append(country)
+        contributions.append(country_contribution)
+    return countries, contributions
+
+
+def sorted_ties(values):
+    '''
+    Returns the sort order of the values and the start positions of groups of tied values.
+    '''
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    tie_start = np.ones(len(values), dtype=bool)
+    tie_start[1:] = sorted_values[1:] != sorted_values[:-1]
+    return order, np.flatnonzero(tie_start)
+
+
+def firm_weights(rng, n_firms, n_replicates):
+    '''
+    Draws n_firms firms with replacement for each replicate and returns how often each firm was drawn.
+    '''
+    draws = rng.integers(0, n_firms, size=(n_replicates, n_firms))
+    offsets = np.arange(n_replicates)[:, None] * n_firms
+    counts = np.bincount((draws + offsets).ravel(), minlength=n_replicates * n_firms)
+    return counts.reshape(n_replicates, n_firms)
+
+
+def weighted_median(sorted_values, row_weights):
+    '''
+    Returns the median of sorted values repeated by integer weights, one per replicate row.
+    '''
+    if len(sorted_values) == 0:
+        return np.full(row_weights.shape[0], np.nan)
+    cumulative = np.cumsum(row_weights, axis=1)
+    total = cumulative[:, -1]
+    lower = (cumulative > ((total - 1) // 2)[:, None]).argmax(axis=1)
+    upper = (cumulative > (total // 2)[:, None]).argmax(axis=1)
+    median = (sorted_values[lower] + sorted_values[upper]) / 2
+    median[total == 0] = np.nan
+    return median
+
+
+def weighted_ranks(ties, row_weights):
+    '''
+    Returns average ranks of values repeated by integer weights, one row per replicate.
+    '''
+    order, tie_starts = ties
+    sorted_weights = row_weights[:, order]
+    group_weights = np.add.reduceat(sorted_weights, tie_starts, axis=1)
+    group_ranks = np.cumsum(group_weights, axis=1) - group_weights + (group_weights + 1) / 2
+    group_sizes = np.diff(np.append(tie_starts, len(order)))
+    ranks = np.empty(sorted_weights.shape, dtype=np.float64)
+    ranks[:, order] = np.repeat(group_ranks, group_sizes, axis=1)
+    return ranks
+
+
+def weighted_spearman(contribution, weights):
+    '''
+    Returns the Spearman correlation of firm-year pairs repeated by the firm weights, one per replicate.
+    '''
+    firm_index, x_ties, y_ties = contribution
+    if len(firm_index) == 0:
+        return np.full(weights.shape[0], np.nan)
+    row_weights = weights[:, firm_index]
+    total = row_weights.sum(axis=1)[:, None]
+    centered_x = weighted_ranks(x_ties, row_weights) - (total + 1) / 2
+    centered_y = weighted_ranks(y_ties, row_weights) - (total + 1) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (
+            (row_weights * centered_x * centered_y).sum(axis=1)
+            / np.sqrt((row_weights * centered_x ** 2).sum(axis=1) * (row_weights * centered_y ** 2).sum(axis=1))
+        )
+
+
+def country_replicates(contribution, weights, min_small_losses=5):
+    '''
+    Computes EM1-EM4 of one country for each row of firm weights.
+    '''
+    em1_values, em1_firms = contribution['EM1']
+    em3_values, em3_firms = contribution['EM3']
+    small_profits = weights @ contribution['small_profits']
+    small_losses = weights @ contribution['small_losses']
+
+    # Countries with fewer than min_small_losses small losses have no EM4, as in calculate_em4
+    em4 = small_profits / np.maximum(1, small_losses)
+    em4[small_losses < min_small_losses] = np.nan
+
+    return {
+        'EM1': weighted_median(em1_values, weights[:, em1_firms]),
+        'EM2': weighted_spearman(contribution['EM2'], weights),
+        'EM3': weighted_median(em3_values, weights[:, em3_firms]),
+        'EM4': em4,
+    }
+
+
+def rank_replicates(metrics):
+    '''
+    Ranks the countries within each replicate and computes the aggregate score as in calculate_aggregate.
+
+    Takes a dict of (replicates x countries) arrays of EM1-EM4. Metrics are rounded to three
+    decimals before ranking, and countries without EM4 are left out of the ranking of that
+    replicate. Adds the ranks, the Aggregate_EM_Score and the country's Aggregate_Rank.
+    '''
+    ranked = {metric: np.round(metrics[metric], 3) for metric in EM_METRICS}
+    excluded = np.isnan(ranked['EM4'])
+    for metric in EM_METRICS:
+        values = np.where(excluded, np.nan, ranked[metric])
+        ranked[f'Rank_{metric}'] = pd.DataFrame(values).rank(axis=1, ascending=RANK_ASCENDING[metric]).to_numpy()
+    with np.errstate(invalid='ignore'):
+        rank_stack = np.stack([ranked[f'Rank_{metric}'] for metric in EM_METRICS])
+        all_missing = np.isnan(rank_stack).all(axis=0)
+        aggregate = np.nansum(rank_stack, axis=0) / np.maximum(1, (~np.isnan(rank_stack)).sum(axis=0))
+    aggregate[all_missing] = np.nan
+    ranked['Aggregate_EM_Score'] = np.round(aggregate, 1)
+    ranked['Aggregate_Rank'] = pd.DataFrame(ranked['Aggregate_EM_Score']).rank(axis=1, ascending=False).to_numpy()
+    return ranked
+
+
+def run_replicates(contributions, seed_sequence, n_replicates, min_small_losses=5):
+    '''
+    Runs a batch of bootstrap replicates and returns the country metrics as (replicates x countries) arrays.
+    '''
+    rng = np.random.default_rng(seed_sequence)
+    metrics = {metric: np.empty((n_replicates, len(contributions))) for metric in EM_METRICS}
+    for i, contribution in enumerate(contributions):
+        weights = firm_weights(rng, contribution['n_firms'], n_replicates)
+        for metric, values in country_replicates(contribution, weights, min_small_losses).items():
+            metrics[metric][:, i] = values
+    return metrics
+
+
+def _init_worker(contributions):
+    global _worker_contributions
+    _worker_contributions = contributions
+
+
+def _run_worker_batch(seed_sequence, n_replicates, min_small_losses):
+    return run_replicates(_worker_contributions, seed_sequence, n_replicates, min_small_losses)
+
+
+def bootstrap_em(em_values, n_replicates=1000, seed=266, workers=1, batch_size=50, min_small_losses=5):
+    '''
+    Bootstraps EM1-EM4, the ranks and the aggregate score by resampling firms within each country.
+
+    Replicates are split into batches of batch_size. Each batch gets its own seed spawned
+    from the base seed, so the results only depend on the seed and the batch size, not on
+    the number of worker processes. With workers > 1 the batches run in a process pool.
+
+    Returns a dict of (replicates x countries) arrays and the list of countries.
+    '''
+    countries, contributions = build_contributions(em_values)
+    batch_sizes = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(contributions,)) as pool:
+            batches = list(pool.map(
+                _run_worker_batch, seed_sequences, batch_sizes, [min_small_losses] * len(batch_sizes)
+            ))
+    else:
+        batches = [
+            run_replicates(contributions, s, n, min_small_losses) for s, n in zip(seed_sequences, batch_sizes)
+        ]
+
+    metrics = {metric: np.concatenate([batch[metric] for batch in batches]) for metric in EM_METRICS}
+    return rank_replicates(metrics), countries
+
+
+def bootstrap_intervals(replicates, countries, confidence=0.95):
+    '''
+    Summarizes bootstrap replicates as percentile intervals per country and statistic.
+
+    Returns a tidy table with the country, the statistic, the lower and upper bounds,
+    the bootstrap median and the share of replicates in which the statistic was defined.
+    '''
+    alpha = (1 - confidence) / 2 * 100
+    rows = []
+    for statistic, values in replicates.items():
+        defined = ~np.isnan(values)
+        with warnings.catch_warnings():
+            # Statistics that are undefined in every replicate get NaN bounds
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, median, upper = np.nanpercentile(values, [alpha, 50, 100 - alpha], axis=0)
+        rows.append(pd.DataFrame({
+            'item6026': countries,
+            'statistic': statistic,
+            'lower': lower,
+            'median': median,
+            'upper': upper,
+            'share_defined': defined.mean(axis=0),
+        }))
+    return pd.concat(rows, ignore_index=True)
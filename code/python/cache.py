@@ -0,0 +1,193 @@
+# --- Header -------------------------------------------------------------------
+# Content-hashed on-disk cache for pipeline stages
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import pandas as pd
+from utils import setup_logging
+
+log = setup_logging()
+
+
+def hash_file(path, block_size=1 << 20):
+    '''
+    Returns the sha256 hash of a file's content. For a directory of table files, the names
+    and contents of the files are hashed in name order, skipping the files starting with
+    '_' or '.' that the readers of the directory skip as well.
+    '''
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        names = [name for name in sorted(os.listdir(path)) if not name.startswith(('_', '.'))]
+        file_paths = [os.path.join(path, name) for name in names]
+    else:
+        names, file_paths = [None], [path]
+    for name, file_path in zip(names, file_paths):
+        if name is not None:
+            digest.update(name.encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_frame(df):
+    '''
+    Returns the sha256 hash of a dataframe's content: its columns, dtypes and values in row order.
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(column), str(dtype)] for column, dtype in df.dtypes.items()]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def hash_code(*functions):
+    '''
+    Returns a hash of the source code of the given functions and classes.
+    '''
+    digest = hashlib.sha256()
+    for function in functions:
+        digest.update(inspect.getsource(function).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hash_config(cfg, keys):
+    '''
+    Returns a hash of the selected configuration entries.
+    '''
+    payload = json.dumps({key: cfg[key] for key in keys}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class StageCache:
+    '''
+    On-disk cache of stage results, keyed on hashes of the stage inputs, config and code.
+
+    Each entry is one pickle file named after its key. Reading an entry refreshes its
+    modification time, and after every write the least recently used entries are
+    removed until the cache fits into max_bytes.
+    '''
+
+    def __init__(self, cache_dir, max_bytes, enabled=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        if enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage, *parts):
+        '''
+        Combines the stage name and the hashes of its inputs into a cache key.
+        '''
+        digest = hashlib.sha256(stage.encode('utf-8'))
+        for part in parts:
+            digest.update(str(part).encode('utf-8'))
+        return f"{stage}-{digest.hexdigest()[:32]}"
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pickle")
+
+    def get(self, key):
+        '''
+        Returns (True, value) for a cached key and (False, None) otherwise.
+        '''
+        if not self.enabled or not os.path.exists(self.path(key)):
+            return False, None
+        with open(self.path(key), 'rb') as f:
+            value = pickle.load(f)
+        os.utime(self.path(key))
+        return True, value
+
+    def put(self, key, value):
+        '''
+        Stores a value and evicts the least recently used entries beyond the size limit.
+        '''
+        if not self.enabled:
+            return
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def cached(self, key, function, *args, **kwargs):
+        '''
+        Returns the cached result for the key, or computes it with the function and stores it.
+        '''
+        hit, value = self.get(key)
+        if hit:
+            log.info(f"Cache hit for {key}")
+            return value
+        value = function(*args, **kwargs)
+        self.put(key, value)
+        return value
+
+    def entries(self):
+        '''
+        Returns a table of the cache entries with their size and last access, most recent first.
+        '''
+        rows = []
+        if os.path.isdir(self.cache_dir):
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith('.pickle'):
+                    continue
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                rows.append({
+                    'key': file_name[:-len('.pickle')],
+                    'size_mb': stat.st_size / 2**20,
+                    'last_access': pd.Timestamp(stat.st_mtime, unit='s'),
+                })
+        entries = pd.DataFrame(rows, columns=['key', 'size_mb', 'last_access'])
+        return entries.sort_values('last_access', ascending=False).reset_index(drop=True)
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits into max_bytes.
+        '''
+        entries = self.entries()
+        total_bytes = entries['size_mb'].sum() * 2**20
+        for entry in entries.iloc[::-1].itertuples():
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(self.path(entry.key))
+            total_bytes -= entry.size_mb * 2**20
+            log.info(f"Evicted {entry.key} from the cache")
+
+    def clear(self):
+        for key in self.entries()['key']:
+            os.remove(self.path(key))
+
+
+def add_cache_arguments(parser):
+    '''
+    Adds the command line flags to bypass, inspect or clear the stage cache.
+    '''
+    parser.add_argument('--no-cache', action='store_true', help='Recompute all stages without reading or writing the cache.')
+    parser.add_argument('--cache-info', action='store_true', help='List the cache entries and exit.')
+    parser.add_argument('--clear-cache', action='store_true', help='Remove all cache entries before running.')
+
+
+def open_cache(cfg, args):
+    '''
+    Opens the stage cache configured in cfg and handles the cache command line flags.
+
+    Returns None if --cache-info was given and the caller should exit.
+    '''
+    cache = StageCache(cfg['cache_dir'], cfg['cache_max_mb'] * 2**20, enabled=not args.no_cache)
+    if args.cache_info:
+        entries = cache.entries()
+        log.info(f"{len(entries)} cache entries, {entries['size_mb'].sum():.1f} of {cfg['cache_max_mb']} MB used")
+        if not entries.empty:
+            log.info(f"\n{entries.to_string(index=False)}")
+        return None
+    if args.clear_cache:
+        cache.clear()
+        log.info("Cache cleared")
+    return cache
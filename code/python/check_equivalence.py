@@ -0,0 +1,148 @@
+# --- Header -------------------------------------------------------------------
+# Checks that the alternative execution paths give the same results on a synthetic panel
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import sys
+import tempfile
+
+import pandas as pd
+import duckdb_engine
+from data_source import LocalSource, fill_local_database
+from do_analysis import (
+    build_em_panel, calculate_em1, calculate_em2, calculate_em3, calculate_em4, calculate_em_sharded,
+    firm_year_results, load_data
+)
+from prepare_data import prepare_financial_data
+from pull_wrds_data import check_filter_pushdown, pull_wrds_data
+from results_store import FirmYearStore, write_results_store
+from storage import read_table, write_table
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+EM_METRICS = ['EM1', 'EM2', 'EM3', 'EM4']
+
+
+def main():
+    '''
+    Runs the pull, the preparation and the analysis on a synthetic panel along every
+    alternative path and exits with an error if any of them differs:
+
+    - the pull with the filters in SQL and in pandas,
+    - the preparation and EM1-EM4 on the pandas and the duckdb engine, and the results
+      store written by both engines,
+    - EM1-EM4 calculated serially and on country shards with em_workers processes.
+
+    The synthetic data is written to a temporary directory, the data and outputs of
+    the project are not touched.
+    '''
+    parser = argparse.ArgumentParser(description='Check that the alternative execution paths give the same results.')
+    parser.add_argument('--rows', type=int, default=100000, help='Number of synthetic firm-year rows.')
+    parser.add_argument('--seed', type=int, default=266, help='Seed of the synthetic panel.')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes of the sharded calculation.')
+    args = parser.parse_args()
+
+    log.info("Checking the equivalence of the execution paths ...")
+    pull_cfg = read_config('config/pull_data_cfg.yaml')
+    prepare_cfg = read_config('config/prepare_data_cfg.yaml')
+    analysis_cfg = read_config('config/do_analysis_cfg.yaml')
+
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def tmp_path(name):
+            return os.path.join(tmp_dir, name)
+
+        # Pull the synthetic panel from the local database with the filters in SQL and in pandas
+        pull_cfg = {**pull_cfg, 'data_source': 'local', 'local_database': tmp_path('tr_worldscope.sqlite')}
+        fill_local_database(pull_cfg['local_database'], args.rows, seed=args.seed, countries=(
+            pull_cfg['included_countries'] + pull_cfg['excluded_countries']
+        ))
+        with LocalSource(pull_cfg['local_database']) as source:
+            if not check_filter_pushdown(pull_cfg, source):
+                failed.append('SQL and pandas filtering')
+            pulled = pull_wrds_data({**pull_cfg, 'filter_location': 'sql'}, source)
+        write_table(pulled, tmp_path('pulled.parquet'))
+
+        # Prepare the pulled data on both engines
+        engine_cfg = {
+            **prepare_cfg, **analysis_cfg,
+            'worldscope_sample_save_path': tmp_path('pulled.parquet'), 'lazy_source': tmp_path('pulled.parquet'),
+            'duckdb_temp_dir': tmp_path('duckdb_tmp'),
+        }
+        write_table(prepare_financial_data(engine_cfg), tmp_path('prepared_pandas.parquet'))
+        duckdb_engine.prepare_financial_data_lazy({**engine_cfg, 'prepared_data_save_path': tmp_path('prepared_duckdb.parquet')})
+        check(failed, 'pandas and duckdb preparation', lambda: pd.testing.assert_frame_equal(
+            sort_rows(read_table(tmp_path('prepared_pandas.parquet'))),
+            sort_rows(read_table(tmp_path('prepared_duckdb.parquet'))),
+            check_categorical=False
+        ))
+
+        # Calculate EM1-EM4 serially, on country shards and on the duckdb engine from the same prepared data
+        engine_cfg['prepared_data_save_path'] = tmp_path('prepared_pandas.parquet')
+        profit_band, min_small_losses = analysis_cfg['em4_profit_band'], analysis_cfg['em4_min_small_losses']
+        em_panel = build_em_panel(load_data(engine_cfg['prepared_data_save_path']))
+        serial = [
+            calculate_em1(em_panel), calculate_em2(em_panel), calculate_em3(em_panel),
+            calculate_em4(em_panel, profit_band, min_small_losses),
+        ]
+        sharded = calculate_em_sharded(em_panel, profit_band, min_small_losses, args.workers)
+        lazy = duckdb_engine.calculate_em_lazy(engine_cfg)
+        for metric, serial_result, sharded_result, lazy_result in zip(EM_METRICS, serial, sharded, lazy):
+            check(failed, f'serial and sharded {metric}', lambda: pd.testing.assert_frame_equal(
+                country_table(serial_result[0]), country_table(sharded_result[0])
+            ))
+            # The country values are rounded to three decimals, sums in another order can move them by one unit
+            check(failed, f'pandas and duckdb {metric}', lambda: pd.testing.assert_frame_equal(
+                country_table(serial_result[0]), country_table(lazy_result[0]), check_exact=False, rtol=0, atol=1.5e-3
+            ))
+
+        # Write the results store on both engines and compare the firm-years and the firm index
+        write_results_store(firm_year_results(em_panel, profit_band), tmp_path('store_pandas'))
+        duckdb_engine.write_results_store_lazy(engine_cfg, tmp_path('store_duckdb'))
+        pandas_store, duckdb_store = FirmYearStore(tmp_path('store_pandas')), FirmYearStore(tmp_path('store_duckdb'))
+        check(failed, 'pandas and duckdb results store', lambda: pd.testing.assert_frame_equal(
+            pandas_store.years(), duckdb_store.years()[pandas_store.dataset.schema.names], check_exact=False
+        ))
+        check(failed, 'pandas and duckdb firm index', lambda: pd.testing.assert_frame_equal(
+            pandas_store.firm_index(), duckdb_store.firm_index()
+        ))
+
+    if failed:
+        log.error(f"{len(failed)} checks failed: {', '.join(failed)}")
+        sys.exit(1)
+    log.info("Checking the equivalence of the execution paths ... Done! All paths give the same results")
+
+
+def check(failed, name, assertion):
+    '''
+    Runs an assertion and adds its name to failed if it does not hold.
+    '''
+    try:
+        assertion()
+    except AssertionError as e:
+        log.error(f"{name} differ: {e}")
+        failed.append(name)
+        return
+    log.info(f"{name} are the same")
+
+
+def sort_rows(df):
+    '''
+    Returns the firm-years sorted by firm and year with a fresh index.
+    '''
+    return df.sort_values(['item6105', 'year_']).reset_index(drop=True)
+
+
+def country_table(df):
+    '''
+    Returns a country table with the countries as strings and the values as float64.
+    '''
+    return df.astype({'item6026': str}).astype({column: 'float64' for column in df.columns if column != 'item6026'})
+
+
+if __name__ == "__main__":
+    main()
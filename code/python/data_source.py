@@ -0,0 +1,257 @@
+# --- Header -------------------------------------------------------------------
+# Data sources for the Worldscope pull: WRDS and a local SQLite stand-in
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+from instrument import stage
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+# Schemas of the Worldscope tables in the local database. They contain the columns of
+# tr_worldscope.wrds_ws_funda and tr_worldscope.wrds_ws_company that this project pulls,
+# with the column types of WRDS. More items can be added as further columns.
+WS_FUNDA_SCHEMA = {
+    'item6105': 'VARCHAR(8)',   # Worldscope Permanent ID
+    'year_': 'INTEGER',         # Year
+    'freq': 'VARCHAR(1)',       # Frequency, 'A' for annual data
+    'item5350': 'DATE',         # Fiscal Period End Date
+    'item2003': 'DOUBLE PRECISION',  # Cash
+    'item3051': 'DOUBLE PRECISION',  # Short Term Debt and Current Portion of Long Term Debt
+    'item3063': 'DOUBLE PRECISION',  # Income Taxes Payable
+    'item1151': 'DOUBLE PRECISION',  # Depreciation, depletion, and amortization
+    'item2999': 'DOUBLE PRECISION',  # Total Assets
+    'item1001': 'DOUBLE PRECISION',  # Net Sales or Revenues
+    'item1250': 'DOUBLE PRECISION',  # Operating Income
+    'item1651': 'DOUBLE PRECISION',  # Net Income before preferred dividends
+    'item3101': 'DOUBLE PRECISION',  # Current Liabilities - Total
+    'item2201': 'DOUBLE PRECISION',  # Current Assets - Total
+}
+
+WS_COMPANY_SCHEMA = {
+    'item6105': 'VARCHAR(8)',   # Worldscope Permanent ID
+    'item6001': 'VARCHAR(60)',  # Company Name
+    'item6100': 'VARCHAR(1)',   # Entity Type
+    'item6026': 'VARCHAR(30)',  # Country Code
+    'item7021': 'DOUBLE PRECISION',  # SIC Code
+}
+
+# Indexes of the local tables, for the year partitions and the keyset pagination of the pull
+WS_INDEXES = [
+    'CREATE INDEX wrds_ws_funda_id_year ON wrds_ws_funda (item6105, year_)',
+    'CREATE INDEX wrds_ws_funda_year ON wrds_ws_funda (year_)',
+    'CREATE UNIQUE INDEX wrds_ws_company_id ON wrds_ws_company (item6105)',
+]
+
+
+def main():
+    '''
+    Creates the local Worldscope database and fills it with a synthetic panel.
+    '''
+    parser = argparse.ArgumentParser(description='Create a local Worldscope database with synthetic data.')
+    parser.add_argument('--rows', type=int, required=True, help='Number of synthetic firm-year rows.')
+    parser.add_argument('--seed', type=int, default=266, help='Seed of the synthetic panel.')
+    args = parser.parse_args()
+
+    cfg = read_config('config/pull_data_cfg.yaml')
+    log.info(f"Filling {cfg['local_database']} with {args.rows} synthetic firm-years ...")
+    fill_local_database(cfg['local_database'], args.rows, seed=args.seed, countries=(
+        cfg['included_countries'] + cfg['excluded_countries']
+    ))
+    log.info(f"Filling {cfg['local_database']} with {args.rows} synthetic firm-years ... Done!")
+
+
+class DataSource(ABC):
+    '''
+    Connection to a database with the tr_worldscope tables.
+
+    A data source holds one connection for the whole run, which every query reuses.
+    Queries and streamed chunks are recorded as stages of the run metrics, so the
+    query shape, the chunk sizes and the transfer time of a pull can be compared.
+    Sources implement read_sql, stream_sql and close.
+    '''
+
+    name = None
+
+    def raw_sql(self, sql):
+        '''
+        Runs a query and returns the result as a dataframe.
+        '''
+        with stage('raw_sql') as step:
+            df = self.read_sql(sql)
+            step['rows_out'] = len(df)
+            step['details']['query'] = sql
+        return df
+
+    def read_chunks(self, sql, chunksize):
+        '''
+        Runs a query and yields its result in dataframes of chunksize rows.
+        The rows are fetched from the database as they are needed.
+        '''
+        chunks = self.stream_sql(sql, chunksize)
+        while True:
+            with stage('read_chunk') as step:
+                chunk = next(chunks, None)
+                step['rows_out'] = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                return
+            yield chunk
+
+    @abstractmethod
+    def read_sql(self, sql):
+        '''
+        Returns the result of a query as a dataframe.
+        '''
+
+    @abstractmethod
+    def stream_sql(self, sql, chunksize):
+        '''
+        Returns an iterator over the result of a query in dataframes of chunksize rows.
+        '''
+
+    @abstractmethod
+    def close(self):
+        '''
+        Closes the connection.
+        '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class WrdsSource(DataSource):
+    '''
+    The WRDS PostgreSQL server, reached through wrds.Connection.
+    '''
+
+    name = 'WRDS'
+
+    def __init__(self, wrds_username, wrds_password):
+        import wrds
+
+        self.db = wrds.Connection(wrds_username=wrds_username, wrds_password=wrds_password)
+        log.info('Logged on to WRDS ...')
+
+    def read_sql(self, sql):
+        return self.db.raw_sql(sql)
+
+    def stream_sql(self, sql, chunksize):
+        from sqlalchemy import text
+
+        # Server-side cursor for this statement only, so the rows are sent chunk by chunk. Setting
+        # the option on the shared connection would give every later query a server-side cursor.
+        statement = text(sql).execution_options(stream_results=True)
+        yield from pd.read_sql_query(statement, self.db.connection, chunksize=chunksize)
+
+    def close(self):
+        self.db.close()
+        log.info("Disconnected from WRDS")
+
+
+class LocalSource(DataSource):
+    '''
+    A local SQLite file with the tr_worldscope tables, as a stand-in for WRDS.
+
+    The file is attached as the schema tr_worldscope, so the queries of the pull run
+    unchanged. Create and fill it with create_local_database and fill_local_database.
+    '''
+
+    name = 'local database'
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Local database {path} not found. Create it with code/python/data_source.py")
+        self.connection = connect_local_database(path)
+        log.info(f"Connected to the local database {path}")
+
+    def read_sql(self, sql):
+        return pd.read_sql_query(sql, self.connection)
+
+    def stream_sql(self, sql, chunksize):
+        yield from pd.read_sql_query(sql, self.connection, chunksize=chunksize)
+
+    def close(self):
+        self.connection.close()
+        log.info("Disconnected from the local database")
+
+
+def open_source(cfg, wrds_login=None):
+    '''
+    Opens the data source selected by data_source in the pull config.
+    '''
+    if cfg['data_source'] == 'wrds':
+        return WrdsSource(wrds_login['wrds_username'], wrds_login['wrds_password'])
+    if cfg['data_source'] == 'local':
+        return LocalSource(cfg['local_database'])
+    raise ValueError(f"Unknown data_source '{cfg['data_source']}'. Use 'wrds' or 'local'.")
+
+
+def connect_local_database(path):
+    '''
+    Opens a SQLite connection with the database file attached as tr_worldscope.
+    '''
+    connection = sqlite3.connect(':memory:')
+    connection.execute('ATTACH DATABASE ? AS tr_worldscope', (path,))
+    return connection
+
+
+def create_local_database(path):
+    '''
+    Creates the local database file with empty Worldscope tables, replacing an existing file.
+    Returns a connection to the file itself, in which the tables have no schema prefix.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path)
+    for table, schema in [('wrds_ws_funda', WS_FUNDA_SCHEMA), ('wrds_ws_company', WS_COMPANY_SCHEMA)]:
+        columns = ', '.join(f"{column} {column_type}" for column, column_type in schema.items())
+        connection.execute(f"CREATE TABLE {table} ({columns})")
+    connection.commit()
+    return connection
+
+
+def fill_local_database(path, n_rows, seed=266, countries=None, other_entity_share=0.02):
+    '''
+    Creates the local database and fills it with a synthetic panel from synthetic.generate_panel.
+
+    Besides the firm-years that pass the sample filters, the tables contain financial
+    firms, firms from excluded countries (if countries includes them) and a share of
+    entities that are not companies, so the pull filters have something to remove.
+    '''
+    from synthetic import generate_panel
+
+    connection = create_local_database(path)
+    rng = np.random.default_rng(seed)
+    try:
+        for chunk in generate_panel(n_rows, seed=seed, countries=countries):
+            funda = chunk[[column for column in WS_FUNDA_SCHEMA if column != 'freq']].copy()
+            funda['freq'] = 'A'
+            funda['item5350'] = funda['item5350'].dt.strftime('%Y-%m-%d')
+            funda.to_sql('wrds_ws_funda', connection, if_exists='append', index=False)
+
+            company = chunk[list(WS_COMPANY_SCHEMA)].drop_duplicates('item6105')
+            company['item6026'] = company['item6026'].astype(str)
+            other_entity = rng.random(len(company)) < other_entity_share
+            company['item6100'] = np.where(other_entity, 'S', company['item6100'])
+            company.to_sql('wrds_ws_company', connection, if_exists='append', index=False)
+        for index in WS_INDEXES:
+            connection.execute(index)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
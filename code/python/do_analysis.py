@@ -1,180 +1,530 @@
 # We start by loading the libraries that we will use in this analysis.
+import argparse
+import multiprocessing
 import pickle
+import resource
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import bootstrap
+from bootstrap import bootstrap_em, bootstrap_intervals
+import duckdb_engine
+from cache import StageCache, add_cache_arguments, hash_code, hash_config, hash_file, open_cache
+from instrument import add_metrics_arguments, instrumented, record, recorder, start_metrics
+from panel import FirmPanel, grouped_spearman
+from sharding import run_sharded
+from results_store import finish_results_store, read_store_key, write_results_store
+from storage import apply_schema, read_table
 from utils import read_config, setup_logging
 
 # Set up logging
 log = setup_logging()
 
+# Columns of the prepared data that are needed for the EM metrics
+ANALYSIS_COLUMNS = [
+    'item6105', 'year_', 'item6026', 'item2003', 'item3051', 'item3063', 'item1151',
+    'item2999', 'item1250', 'item1651', 'item3101', 'item2201'
+]
+
+# Columns of the EM panel: identifiers, net earnings for EM4 and the firm-level inputs from build_em_panel
+EM_PANEL_COLUMNS = [
+    'item6105', 'year_', 'item6026', 'item1651', 'Accruals', 'CFO', 'std_operating_income', 'std_cfo',
+    'lagged_total_assets', 'delta_Accruals', 'delta_CFO'
+]
+
 def main():
+    parser = argparse.ArgumentParser(description='Calculate the earnings management measures.')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    parser.add_argument(
+        '--compare-memory', action='store_true',
+        help='Measure the peak memory of the EM calculation with and without low_memory and exit.'
+    )
+    args = parser.parse_args()
+
     log.info("Performing main analysis...")
     
     # Load the configuration file
     cfg = read_config('config/do_analysis_cfg.yaml')
-    
-    # Load the prepared financial data using the path from the config file
-    financial_data = load_data(cfg['prepared_data_save_path'])
+    if args.compare_memory:
+        compare_memory(cfg)
+        return
+    cache = open_cache(cfg, args)
+    if cache is None:
+        return
+    start_metrics(cfg, args)
+
+    run_analysis(cfg, cache)
+
+    # Save the timings, memory and row counts of the stages that were computed in this run
+    recorder.write(cfg['metrics'], low_memory=cfg['low_memory'], cache=cache.enabled)
+    recorder.stop()
+
+    log.info("Performing main analysis...Done!")
+
+def run_analysis(cfg, cache, prepared=None, data_hash=None):
+    """
+    Calculate EM1-EM4 and the aggregate score, save the results and return the final table.
+    By default the prepared data is loaded from prepared_data_save_path. Prepared data that is
+    already in memory can be passed as prepared, together with a hash of its content for the cache keys.
+    """
+    if prepared is not None and cfg['engine'] == 'duckdb':
+        raise ValueError("The duckdb engine reads the prepared data from prepared_data_save_path, not from memory")
+    if cfg['bootstrap_replicates'] > 0 and cfg['engine'] == 'duckdb':
+        # The bootstrap resamples the firm-year values of the whole panel in memory
+        raise ValueError(
+            "The bootstrap needs the whole panel in memory and does not run on the duckdb engine. "
+            "Set bootstrap_replicates to 0 or use the pandas engine"
+        )
+
+    # Each stage is cached under a key built from the hashes of its inputs, settings and code,
+    # so a stage is only recomputed if one of them changed
+    panel_key = StageCache.key(
+        'em_panel', data_hash if prepared is not None else hash_file(cfg['prepared_data_save_path']),
+        hash_config(cfg, ['low_memory']), hash_code(load_data, select_data, build_em_panel, accruals_and_cfo, FirmPanel)
+    )
+    # The duckdb engine computes EM1-EM4 in its own query plans, so its results get their own keys
+    engine_key = hash_code(duckdb_engine) if cfg['engine'] == 'duckdb' else cfg['engine']
+    em1_key = StageCache.key('em1', panel_key, engine_key, hash_code(calculate_em1, em1_values))
+    em2_key = StageCache.key('em2', panel_key, engine_key, hash_code(calculate_em2, em2_values, grouped_spearman))
+    em3_key = StageCache.key('em3', panel_key, engine_key, hash_code(calculate_em3, em3_values))
+    em4_key = StageCache.key(
+        'em4', panel_key, engine_key, hash_config(cfg, ['em4_profit_band', 'em4_min_small_losses']),
+        hash_code(calculate_em4, em4_flags, scaled_net_earnings)
+    )
+    aggregate_key = StageCache.key('aggregate', em1_key, em2_key, em3_key, em4_key, hash_code(calculate_aggregate))
+
+    # The prepared financial data is only loaded and sorted into the panel if a stage needs it
+    em_panel = None
+    def get_em_panel():
+        nonlocal em_panel
+        if em_panel is None:
+            em_panel = cache.cached(panel_key, lambda: build_em_panel(
+                load_data(cfg['prepared_data_save_path'], cfg['low_memory']) if prepared is None
+                else select_data(prepared, cfg['low_memory'])
+            ))
+        return em_panel
+
+    # With em_workers > 1 the four metrics are calculated together on country shards in a process pool.
+    # The results are the same as from the serial functions, so both share the cache entries.
+    # The duckdb engine calculates all four in one pass over the prepared data file.
+    combined_results = None
+    def em_metric(i, calculate):
+        if cfg['engine'] != 'duckdb' and cfg['em_workers'] <= 1:
+            return calculate
+        def get_combined_result():
+            nonlocal combined_results
+            if combined_results is None and cfg['engine'] == 'duckdb':
+                combined_results = duckdb_engine.calculate_em_lazy(cfg)
+            elif combined_results is None:
+                combined_results = calculate_em_sharded(
+                    get_em_panel(), cfg['em4_profit_band'], cfg['em4_min_small_losses'], cfg['em_workers']
+                )
+            return combined_results[i]
+        return get_combined_result
 
     # Calculate EM1
-    country_em1, summary_stats_em1 = calculate_em1(financial_data)
+    country_em1, summary_stats_em1 = cache.cached(em1_key, em_metric(0, lambda: calculate_em1(get_em_panel())))
 
     # Calculate EM2
-    country_em2, summary_stats_em2 = calculate_em2(financial_data)
+    country_em2, summary_stats_em2 = cache.cached(em2_key, em_metric(1, lambda: calculate_em2(get_em_panel())))
 
     # Calculate EM3
-    country_em3, summary_stats_em3 = calculate_em3(financial_data)
+    country_em3, summary_stats_em3 = cache.cached(em3_key, em_metric(2, lambda: calculate_em3(get_em_panel())))
     
     # Calculate EM4
-    country_em4, summary_stats_em4 = calculate_em4(financial_data)
+    country_em4, summary_stats_em4 = cache.cached(em4_key, em_metric(3, lambda: calculate_em4(
+        get_em_panel(), cfg['em4_profit_band'], cfg['em4_min_small_losses']
+    )))
 
     # Calculate Aggregate Earnings Management Score and create final table
-    final_table = calculate_aggregate(country_em1, country_em2, country_em3, country_em4)
+    final_table = cache.cached(
+        aggregate_key, calculate_aggregate, country_em1, country_em2, country_em3, country_em4
+    )
+
+    # Bootstrap confidence intervals for EM1-EM4, the ranks and the aggregate score by resampling firms
+    if cfg['bootstrap_replicates'] > 0:
+        bootstrap_keys = [
+            'em4_profit_band', 'em4_min_small_losses', 'bootstrap_replicates', 'bootstrap_seed',
+            'bootstrap_batch_size', 'bootstrap_confidence'
+        ]
+        bootstrap_key = StageCache.key(
+            'bootstrap', panel_key, hash_config(cfg, bootstrap_keys),
+            hash_code(
+                run_bootstrap, firm_year_em_values, em1_values, em2_values, em3_values, em4_flags, scaled_net_earnings,
+                bootstrap
+            )
+        )
+        intervals = cache.cached(bootstrap_key, lambda: run_bootstrap(get_em_panel(), cfg))
+        with open(cfg['bootstrap_results'], 'wb') as f:
+            pickle.dump({'bootstrap_intervals': intervals}, f)
+
+    # Save the firm-year EM values and their components to the results store, unless it already holds them.
+    # The duckdb engine writes the store from a query over the prepared data file.
+    if cfg['results_store'] is not None:
+        store_key = StageCache.key(
+            'results_store', panel_key, engine_key,
+            hash_config(cfg, ['em4_profit_band', 'results_store_row_group_rows']),
+            hash_code(firm_year_results, firm_year_em_values, em1_values, em2_values, em3_values, em4_flags,
+                      scaled_net_earnings, write_results_store, finish_results_store)
+        )
+        if read_store_key(cfg['results_store']) == store_key:
+            log.info(f"Results store {cfg['results_store']} is up to date")
+        elif cfg['engine'] == 'duckdb':
+            duckdb_engine.write_results_store_lazy(cfg, cfg['results_store'], store_key)
+        else:
+            write_results_store(
+                firm_year_results(get_em_panel(), cfg['em4_profit_band']), cfg['results_store'], store_key,
+                cfg['results_store_row_group_rows']
+            )
 
     # Create the final combined table with both metrics and summary statistics
     final_combined_table = create_final_combined_table(final_table)
 
     # Save the final combined table using the path from the config file
-    save_results(final_combined_table, cfg['results'])
+    save_results(final_combined_table, cfg['results'], final_table)
 
-    log.info("Performing main analysis...Done!")
+    return final_table
+
+@instrumented
+def run_bootstrap(em_panel, cfg):
+    """
+    Bootstrap percentile intervals for EM1-EM4, the ranks and the aggregate score.
+    """
+    log.info(f"Bootstrapping {cfg['bootstrap_replicates']} replicates ...")
+    replicates, countries = bootstrap_em(
+        firm_year_em_values(em_panel, cfg['em4_profit_band']), cfg['bootstrap_replicates'], seed=cfg['bootstrap_seed'], workers=cfg['bootstrap_workers'],
+        batch_size=cfg['bootstrap_batch_size'], min_small_losses=cfg['em4_min_small_losses']
+    )
+    log.info(f"Bootstrapping {cfg['bootstrap_replicates']} replicates ... Done!")
+    return bootstrap_intervals(replicates, countries, confidence=cfg['bootstrap_confidence'])
+
+def measure_em_memory(cfg, low_memory):
+    """
+    Run the EM calculation from loading the data to the aggregate table and measure its memory use.
+    Returns the aggregate table, the peak of the traced Python and NumPy allocations and the peak RSS, both in MB.
+    """
+    tracemalloc.start()
+    em_panel = build_em_panel(load_data(cfg['prepared_data_save_path'], low_memory))
+    country_em1, _ = calculate_em1(em_panel)
+    country_em2, _ = calculate_em2(em_panel)
+    country_em3, _ = calculate_em3(em_panel)
+    country_em4, _ = calculate_em4(em_panel, cfg['em4_profit_band'], cfg['em4_min_small_losses'])
+    final_table = calculate_aggregate(country_em1, country_em2, country_em3, country_em4)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is reported in kilobytes on Linux
+    return final_table, traced_peak / 2**20, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
 
-def load_data(data_path):
+def compare_memory(cfg):
+    """
+    Compare the peak memory of the EM calculation with the default and the low-memory data types.
+    Each mode runs in a fresh process, so the peak RSS of one mode does not include the other.
+    """
+    final_tables = {}
+    for low_memory in [False, True]:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            final_table, traced_mb, rss_mb = pool.submit(measure_em_memory, cfg, low_memory).result()
+        final_tables[low_memory] = final_table
+        log.info(f"low_memory={low_memory}: peak traced memory {traced_mb:.1f} MB, peak RSS {rss_mb:.1f} MB")
+
+    # Scores are compared at the precision of the results table. float32 inputs can move a
+    # rounded score by one unit in the last decimal.
+    merged = pd.merge(final_tables[False], final_tables[True], on='item6026', how='outer', suffixes=('', '_low_memory'))
+    decimals = {'EM1': 3, 'EM2': 3, 'EM3': 3, 'EM4': 3, 'Aggregate_EM_Score': 1}
+    differences = {}
+    for column, digits in decimals.items():
+        default = merged[column].astype(np.float64).round(digits).fillna(np.inf)
+        low_memory = merged[f'{column}_low_memory'].astype(np.float64).round(digits).fillna(np.inf)
+        differences[column] = int((default != low_memory).sum())
+    log.info(f"Countries with a different score in low_memory mode: {differences}")
+
+@instrumented
+def load_data(data_path, low_memory=False):
     """
     Load the prepared financial data from the specified path.
+    Only the columns needed for the analysis are read. With low_memory the financial items
+    are loaded as float32 and the firm identifier as a categorical.
     """
-    df = pd.read_csv(data_path)
+    if not low_memory:
+        return read_table(data_path, columns=ANALYSIS_COLUMNS)
+    df = read_table(data_path, columns=ANALYSIS_COLUMNS, float_dtype='float32')
+    df['item6105'] = df['item6105'].astype('category')
     return df
 
-def calculate_em1(df):
+@instrumented
+def select_data(df, low_memory=False):
     """
-    Calculate EM1 for each firm and then take the country-level median.
-    This function combines all necessary steps into one.
+    Select the columns needed for the analysis from prepared data that is already in memory,
+    with the same types as load_data.
+    """
+    df = apply_schema(df[ANALYSIS_COLUMNS].copy(), float_dtype='float32' if low_memory else 'float64')
+    if low_memory:
+        df['item6105'] = df['item6105'].astype('category')
+    return df
+
+@instrumented
+def build_em_panel(df):
+    """
+    Sort the firm-year data once by firm and year and compute the firm-level inputs of EM1-EM4:
+    accruals, CFO, lagged total assets, firm standard deviations and changes in accruals and CFO.
+    Returns the sorted identifiers and net earnings together with these columns.
+    """
+    panel = FirmPanel(df)
+
+    # Step 1 and 2: Calculate Accruals and Operating Cash Flow (CFO) from the changes within each firm
+    accruals, cfo = accruals_and_cfo(panel)
+
+    # Step 3: Keep only the columns the EM metrics use, the raw balance sheet items are not needed anymore
+    data = panel.data[['item6105', 'year_', 'item6026', 'item1651']].copy()
+    data['Accruals'] = accruals
+    data['CFO'] = cfo
+
+    # Step 4: Calculate the standard deviations for Operating Income and CFO for each firm
+    data['std_operating_income'] = panel.firm_std(panel.values('item1250'))
+    data['std_cfo'] = panel.firm_std(cfo)
+
+    # Step 5: Retrieve Lagged Total Assets
+    data['lagged_total_assets'] = panel.lag(panel.values('item2999'))
+
+    # Step 6: Calculate the changes in Accruals and CFO for EM2
+    data['delta_Accruals'] = panel.diff(accruals)
+    data['delta_CFO'] = panel.diff(cfo)
+
+    return data
+
+def accruals_and_cfo(panel):
+    """
+    Calculate Accruals and CFO for the firm-years of a FirmPanel, in the order of the panel.
     """
-    # Step 1: Calculate Accruals
-    # Group by unique firm (item6105) and calculate diffs within each firm
+    # Step 1: Calculate Accruals from the changes within each firm
     # If a firm does not report information on taxes payable or short-term debt,
     # then the change in both variables is assumed to be zero (per paper).
-    df['delta_CA'] = df.groupby('item6105')['item2201'].diff()  # Change in total current assets
-    df['delta_Cash'] = df.groupby('item6105')['item2003'].diff()  # Change in cash and cash equivalents
-    df['delta_CL'] = df.groupby('item6105')['item3101'].diff()  # Change in total current liabilities
-    df['delta_STD'] = df.groupby('item6105')['item3051'].diff().fillna(0)  # Apply fillna only for STD
-    df['delta_TP'] = df.groupby('item6105')['item3063'].diff().fillna(0)  # Apply fillna only for TP
-    df['Dep'] = df['item1151']  # Depreciation and amortization expense
+    delta_CA = panel.diff(panel.values('item2201'))  # Change in total current assets
+    delta_Cash = panel.diff(panel.values('item2003'))  # Change in cash and cash equivalents
+    delta_CL = panel.diff(panel.values('item3101'))  # Change in total current liabilities
+    delta_STD = np.nan_to_num(panel.diff(panel.values('item3051')))  # Apply fillna only for STD
+    delta_TP = np.nan_to_num(panel.diff(panel.values('item3063')))  # Apply fillna only for TP
+    dep = panel.values('item1151')  # Depreciation and amortization expense
 
-    df['Accruals'] = (df['delta_CA'] - df['delta_Cash']) - (df['delta_CL'] - df['delta_STD'] - df['delta_TP']) - df['Dep']
+    accruals = (delta_CA - delta_Cash) - (delta_CL - delta_STD - delta_TP) - dep
+    del delta_CA, delta_Cash, delta_CL, delta_STD, delta_TP, dep
 
     # Step 2: Calculate Operating Cash Flow (CFO) by subtracting accruals from operating income.
-    df['CFO'] = df['item1250'] - df['Accruals']
+    cfo = panel.values('item1250') - accruals
+    return accruals, cfo
 
-    # Step 3: Calculate the standard deviations for Operating Income and CFO for each firm
-    df['std_operating_income'] = df.groupby('item6105')['item1250'].transform('std')
-    df['std_cfo'] = df.groupby('item6105')['CFO'].transform('std')
+def em1_values(df):
+    """
+    Firm-year EM1: the standard deviation of operating income over the standard deviation of CFO,
+    both scaled by lagged total assets.
+    """
+    scaled_std_operating_income = df['std_operating_income'] / df['lagged_total_assets']
+    scaled_std_cfo = df['std_cfo'] / df['lagged_total_assets']
+    return scaled_std_operating_income / scaled_std_cfo
 
-    # Step 4: Retrieve Lagged Total Assets
-    df['lagged_total_assets'] = df.groupby('item6105')['item2999'].shift(1)
+def em2_values(df):
+    """
+    Firm-year changes in Accruals and CFO scaled by lagged total assets, the inputs of EM2.
+    """
+    scaled_delta_accruals = df['delta_Accruals'] / df['lagged_total_assets']
+    scaled_delta_cfo = df['delta_CFO'] / df['lagged_total_assets']
+    return scaled_delta_accruals, scaled_delta_cfo
+
+def em3_values(df):
+    """
+    Firm-year EM3: the absolute value of accruals over the absolute value of CFO.
+    """
+    return df['Accruals'].abs() / df['CFO'].abs()
 
-    # Step 5: Scale the standard deviations individually by lagged total assets
-    df['scaled_std_operating_income'] = df['std_operating_income'] / df['lagged_total_assets']
-    df['scaled_std_cfo'] = df['std_cfo'] / df['lagged_total_assets']
+def em4_flags(df, profit_band=0.01):
+    """
+    Boolean masks of the firm-years with a small profit and a small loss, based on net earnings
+    (item1651) scaled by lagged total assets within profit_band of zero.
+    """
+    scaled_earnings = scaled_net_earnings(df)
+    small_profits = (scaled_earnings >= 0) & (scaled_earnings <= profit_band)
+    small_losses = (scaled_earnings >= -profit_band) & (scaled_earnings < 0)
+    return small_profits, small_losses
+
+def scaled_net_earnings(df):
+    """
+    Firm-year net earnings (item1651) scaled by lagged total assets, the input of EM4.
+    """
+    return df['item1651'] / df['lagged_total_assets']
 
-    # Step 6: Calculate EM1 as the ratio of the scaled standard deviations
-    df['EM1'] = df['scaled_std_operating_income'] / df['scaled_std_cfo']
+def firm_year_em_values(df, profit_band=0.01):
+    """
+    Collect the firm-year values behind EM1-EM4 in one frame for the bootstrap.
+    """
+    scaled_delta_accruals, scaled_delta_cfo = em2_values(df)
+    small_profits, small_losses = em4_flags(df, profit_band)
+    return pd.DataFrame({
+        'item6105': df['item6105'],
+        'item6026': df['item6026'],
+        'EM1': em1_values(df),
+        'EM3': em3_values(df),
+        'scaled_delta_Accruals': scaled_delta_accruals,
+        'scaled_delta_CFO': scaled_delta_cfo,
+        'small_profits': small_profits,
+        'small_losses': small_losses,
+    })
+
+@instrumented
+def firm_year_results(df, profit_band=0.01):
+    """
+    Collect the firm-year EM values and the accrual components behind them for the results store.
+    The values stay numeric, the store is queried by firm, country and year.
+    """
+    results = df[[
+        'item6105', 'item6026', 'year_', 'Accruals', 'CFO', 'lagged_total_assets', 'std_operating_income',
+        'std_cfo', 'delta_Accruals', 'delta_CFO'
+    ]].copy()
+    em_values = firm_year_em_values(df, profit_band)
+    for column in ['EM1', 'EM3', 'scaled_delta_Accruals', 'scaled_delta_CFO', 'small_profits', 'small_losses']:
+        results[column] = em_values[column]
+    results['scaled_net_earnings'] = scaled_net_earnings(df)
+    return results
+
+@instrumented
+def calculate_em1(df):
+    """
+    Calculate EM1 for each firm and then take the country-level median.
+    Expects the firm-level inputs from build_em_panel.
+    """
+    # Step 1: Calculate EM1 as the ratio of the standard deviations scaled by lagged total assets
+    em1 = em1_values(df).rename('EM1')
 
-    # Step 7: Group by country (item6026) and calculate the median of EM1 for each country
-    country_em1 = df.groupby('item6026')['EM1'].median().reset_index()
+    # Step 2: Group by country (item6026) and calculate the median of EM1 for each country
+    country_em1 = em1.groupby(df['item6026'], observed=True).median().reset_index()
     # Round the EM1 results to three decimal places
     country_em1['EM1'] = country_em1['EM1'].round(3)
 
-    # Step 8: Calculate summary statistics (mean, median, std, min, max) for EM1 across countries
+    # Step 3: Calculate summary statistics (mean, median, std, min, max) for EM1 across countries
     summary_stats_em1 = country_em1['EM1'].agg(['mean', 'median', 'std', 'min', 'max']).round(3)
 
     return country_em1, summary_stats_em1
 
+@instrumented
 def calculate_em2(df):
     """
     Calculate EM2, which is the Spearman correlation between the change in Accruals and CFO,
-    both scaled by lagged total assets.
+    both scaled by lagged total assets. Expects the firm-level inputs from build_em_panel.
     """
-    # Step 1: Calculate the change in Accruals and CFO
-    df['delta_Accruals'] = df.groupby('item6105')['Accruals'].diff()
-    df['delta_CFO'] = df.groupby('item6105')['CFO'].diff()
-
-    # Step 2: Scale by lagged total assets
-    df['scaled_delta_Accruals'] = df['delta_Accruals'] / df['lagged_total_assets']
-    df['scaled_delta_CFO'] = df['delta_CFO'] / df['lagged_total_assets']
-
-    # Step 3: Calculate EM2 as the Spearman correlation between scaled changes
-    country_em2 = df.groupby('item6026').apply(
-        lambda x: x[['scaled_delta_Accruals', 'scaled_delta_CFO']].corr(method='spearman').iloc[0, 1]
-    ).reset_index()
+    # Step 1: Scale the changes in Accruals and CFO by lagged total assets
+    scaled_delta_accruals, scaled_delta_cfo = em2_values(df)
+    scaled = pd.DataFrame({
+        'item6026': df['item6026'],
+        'scaled_delta_Accruals': scaled_delta_accruals,
+        'scaled_delta_CFO': scaled_delta_cfo,
+    })
+
+    # Step 2: Calculate EM2 as the Spearman correlation between scaled changes within each country
+    country_em2 = grouped_spearman(scaled, 'item6026', 'scaled_delta_Accruals', 'scaled_delta_CFO').reset_index()
     country_em2.columns = ['item6026', 'EM2']
     # Round the EM2 results to three decimal places
     country_em2['EM2'] = country_em2['EM2'].round(3)
 
-    # Step 4: Calculate summary statistics (mean, median, std, min, max) for EM2 across countries
+    # Step 3: Calculate summary statistics (mean, median, std, min, max) for EM2 across countries
     summary_stats_em2 = country_em2['EM2'].agg(['mean', 'median', 'std', 'min', 'max']).round(3)
 
     return country_em2, summary_stats_em2
 
+@instrumented
 def calculate_em3(df):
     """
     Calculate EM3, which is the country’s median ratio of the absolute value of accruals
-    and the absolute value of the cash flow from operations.
+    and the absolute value of the cash flow from operations. Expects the firm-level inputs from build_em_panel.
     """
-    # Step 1: Calculate the absolute values of Accruals and CFO
-    df['abs_Accruals'] = df['Accruals'].abs()
-    df['abs_CFO'] = df['CFO'].abs()
-
-    # Step 2: Calculate the ratio of abs(Accruals) to abs(CFO)
-    df['EM3'] = df['abs_Accruals'] / df['abs_CFO']
+    # Step 1: Calculate the ratio of abs(Accruals) to abs(CFO)
+    em3 = em3_values(df).rename('EM3')
 
-    # Step 3: Group by country and calculate the median of EM3 for each country
-    country_em3 = df.groupby('item6026')['EM3'].median().reset_index()
+    # Step 2: Group by country and calculate the median of EM3 for each country
+    country_em3 = em3.groupby(df['item6026'], observed=True).median().reset_index()
 
     # Round the EM3 results to three decimal places
     country_em3['EM3'] = country_em3['EM3'].round(3)
 
-    # Step 4: Calculate summary statistics (mean, median, std, min, max) for EM3 across countries
+    # Step 3: Calculate summary statistics (mean, median, std, min, max) for EM3 across countries
     summary_stats_em3 = country_em3['EM3'].agg(['mean', 'median', 'std', 'min', 'max']).round(3)
 
     return country_em3, summary_stats_em3
 
-def calculate_em4(df):
+@instrumented
+def calculate_em4(df, profit_band=0.01, min_small_losses=5):
     """
     Calculate EM4, which is the ratio of the number of small profits to the number of small losses for each country.
-    Small profits and losses are defined based on net earnings (item1651) scaled by lagged total assets.
-    Only include countries with at least 5 small losses.
+    Small profits and losses are defined based on net earnings (item1651) scaled by lagged total assets,
+    within profit_band of zero. Only include countries with at least min_small_losses small losses.
+    Expects the firm-level inputs from build_em_panel.
     """
-    # Step 1: Calculate Net Earnings scaled by Lagged Total Assets
-    df['scaled_net_earnings'] = df['item1651'] / df['lagged_total_assets']
-
-    # Step 2: Identify Small Profits and Small Losses
-    df['small_profits'] = ((df['scaled_net_earnings'] >= 0) & (df['scaled_net_earnings'] <= 0.01)).astype(int)
-    df['small_losses'] = ((df['scaled_net_earnings'] >= -0.01) & (df['scaled_net_earnings'] < 0)).astype(int)
+    # Step 1: Identify Small Profits and Small Losses from net earnings scaled by lagged total assets
+    small_profits, small_losses = em4_flags(df, profit_band)
 
-    # Step 3: Filter countries with at least 5 small losses
-    country_counts = df.groupby('item6026')['small_losses'].sum()
-    eligible_countries = country_counts[country_counts >= 5].index
+    # Step 2: Count small profits and small losses per country
+    country_counts = pd.DataFrame({'small_profits': small_profits, 'small_losses': small_losses}).groupby(
+        df['item6026'], observed=True
+    ).sum()
 
-    filtered_df = df[df['item6026'].isin(eligible_countries)]
+    # Step 3: Filter countries with at least min_small_losses small losses
+    eligible_counts = country_counts[country_counts['small_losses'] >= min_small_losses]
+    eligible_countries = eligible_counts.index
 
     # Step 4: Calculate EM4 as the ratio of Small Profits to Small Losses for each eligible country
-    country_em4 = filtered_df.groupby('item6026').apply(
-        lambda x: x['small_profits'].sum() / max(1, x['small_losses'].sum())  # Avoid division by zero
-    ).reset_index()
-    country_em4.columns = ['item6026', 'EM4']
+    country_em4 = (
+        eligible_counts['small_profits'] / np.maximum(1, eligible_counts['small_losses'])  # Avoid division by zero
+    ).rename('EM4').reset_index()
     # Round the EM4 results to three decimal places
     country_em4['EM4'] = country_em4['EM4'].round(3)
 
     # Step 5: Calculate summary statistics (mean, median, std, min, max) for EM4 across countries
     summary_stats_em4 = country_em4['EM4'].agg(['mean', 'median', 'std', 'min', 'max']).round(3)
 
-    # Print how many countries were excluded
+    # Report how many countries were excluded
     excluded_countries = len(df['item6026'].unique()) - len(eligible_countries)
-    print(f"{excluded_countries} countries were excluded due to having fewer than 5 small losses.")
+    log.info(f"{excluded_countries} countries were excluded due to having fewer than {min_small_losses} small losses.")
+    record(groups_dropped=excluded_countries)
 
     return country_em4, summary_stats_em4
 
+def country_em_tables(df, profit_band=0.01, min_small_losses=5):
+    """
+    Calculate the country tables of EM1, EM2, EM3 and EM4 for the rows of one country.
+    """
+    return (
+        calculate_em1(df)[0], calculate_em2(df)[0], calculate_em3(df)[0],
+        calculate_em4(df, profit_band, min_small_losses)[0],
+    )
+
+@instrumented
+def calculate_em_sharded(df, profit_band=0.01, min_small_losses=5, workers=4):
+    """
+    Calculate EM1 to EM4 with the panel split by country over a pool of worker processes.
+    All four metrics are per-country statistics, so each country is calculated on its own rows
+    and the gathered results are the same as from calculate_em1 to calculate_em4.
+    """
+    # Step 1: Calculate the country tables of all four metrics per country in the worker processes
+    shards = run_sharded(df, 'item6026', country_em_tables, workers, args=(profit_band, min_small_losses))
+    log.info(f"Calculated EM1-EM4 for {len(shards)} countries with {workers} workers")
+
+    # Step 2: Gather the country tables in country order, as the serial groupby returns them,
+    # and calculate the summary statistics across countries
+    results = []
+    for i, metric in enumerate(['EM1', 'EM2', 'EM3', 'EM4']):
+        tables = [country_tables[i] for country_tables in shards.values()]
+        country_em = pd.concat([table for table in tables if not table.empty] or tables[:1], ignore_index=True)
+        summary_stats = country_em[metric].agg(['mean', 'median', 'std', 'min', 'max']).round(3)
+        results.append((country_em, summary_stats))
+
+    # Step 3: Report how many countries were excluded from EM4
+    excluded_countries = len(shards) - len(results[3][0])
+    log.info(f"{excluded_countries} countries were excluded due to having fewer than {min_small_losses} small losses.")
+    record(groups_dropped=excluded_countries)
+
+    return results
+
+@instrumented
 def calculate_aggregate(df_em1, df_em2, df_em3, df_em4):
     """
     Calculate the aggregate earnings management score for each country.
@@ -197,6 +547,10 @@ def calculate_aggregate(df_em1, df_em2, df_em3, df_em4):
 
     # Keep all relevant columns for the final table
     final_table = combined_df[['item6026', 'EM1', 'EM2', 'EM3', 'EM4', 'Aggregate_EM_Score']].sort_values(by='Aggregate_EM_Score', ascending=False).reset_index(drop=True)
+
+    # Countries without all four metrics are not part of the final table
+    all_countries = pd.concat([df['item6026'] for df in [df_em1, df_em2, df_em3, df_em4]]).nunique()
+    record(groups_dropped=all_countries - len(final_table))
     
     return final_table
 
@@ -209,6 +563,7 @@ def create_final_table_and_summary_stats(final_table):
     
     return final_table, summary_stats
 
+@instrumented
 def create_final_combined_table(final_table):
     """
     Create a final combined table with EM1-EM4, aggregate scores, and summary statistics.
@@ -216,51 +571,41 @@ def create_final_combined_table(final_table):
     # Calculate summary statistics for EM1-EM4
     summary_stats = final_table[['EM1', 'EM2', 'EM3', 'EM4']].agg(['mean', 'median', 'std', 'min', 'max']).round(3)
     
-    # Rename the index of summary_stats to be more descriptive
-    summary_stats.index = ['Mean', 'Median', 'Std', 'Min', 'Max']
-    
-    # Create a DataFrame for the summary stats with the same columns as final_table
-    summary_stats_df = pd.DataFrame(
-        summary_stats.values,
-        columns=['EM1', 'EM2', 'EM3', 'EM4'],
-        index=['Mean', 'Median', 'Std', 'Min', 'Max']
-    ).reset_index()
-    
-    # Add the names in the 'item6026' column (which originally holds the country names)
-    summary_stats_df['item6026'] = summary_stats_df['index']
+    # Create the summary rows with the same columns as final_table, named in the 'item6026' column
+    # and formatted to include trailing zeros for all numbers
+    summary_stats_df = pd.DataFrame({'item6026': ['Mean', 'Median', 'Std', 'Min', 'Max']})
+    for column in ['EM1', 'EM2', 'EM3', 'EM4']:
+        summary_stats_df[column] = [f"{x:.3f}" for x in summary_stats[column]]
     summary_stats_df['Aggregate_EM_Score'] = ''
-    
-    # Reorder columns to match the final_table structure and drop the 'index' column
-    summary_stats_df = summary_stats_df[['item6026', 'EM1', 'EM2', 'EM3', 'EM4', 'Aggregate_EM_Score']]
-    
-    # Format the summary_stats_df to include trailing zeros for all numbers
-    summary_stats_df[['EM1', 'EM2', 'EM3', 'EM4']] = summary_stats_df[['EM1', 'EM2', 'EM3', 'EM4']].applymap(lambda x: f"{x:.3f}")
-    
+
+    # Format the country rows the same way, with the aggregate score rounded to one decimal place like in paper
+    formatted_table = pd.DataFrame({'item6026': final_table['item6026'].astype(object)})
+    for column in ['EM1', 'EM2', 'EM3', 'EM4']:
+        formatted_table[column] = [f"{x:.3f}" for x in final_table[column]]
+    formatted_table['Aggregate_EM_Score'] = [f"{x:.1f}" for x in final_table['Aggregate_EM_Score']]
+
     # Insert an empty row after index 30 like in paper
     empty_row = pd.DataFrame([['', '', '', '', '', '']], columns=final_table.columns)
-    final_table_with_blank = pd.concat([final_table.iloc[:31], empty_row, final_table.iloc[31:]], ignore_index=True)
-    
-    # Format the final_table_with_blank to include trailing zeros for all numbers
-    final_table_with_blank[['EM1', 'EM2', 'EM3', 'EM4']] = final_table_with_blank[['EM1', 'EM2', 'EM3', 'EM4']].applymap(lambda x: f"{float(x):.3f}" if x != '' else x)
-    
-    # Round to one decimal place like in paper
-    final_table_with_blank['Aggregate_EM_Score'] = final_table_with_blank['Aggregate_EM_Score'].apply(lambda x: f"{float(x):.1f}" if x != '' else x)
-    
-    final_combined_table = pd.concat([final_table_with_blank, summary_stats_df], ignore_index=True)
+    final_combined_table = pd.concat(
+        [formatted_table.iloc[:31], empty_row, formatted_table.iloc[31:], summary_stats_df], ignore_index=True
+    )
     
-    print("\nFinal Combined Table (with Summary Statistics):")
-    print(final_combined_table)
+    log.info(f"Final Combined Table (with Summary Statistics):\n{final_combined_table.to_string()}")
     
     return final_combined_table
 
-def save_results(final_combined_table, save_path):
+def save_results(final_combined_table, save_path, final_table=None):
     """
     Save the final combined table to a pickle file at the specified path.
+    The numeric final table is saved next to it, if given.
     """
+    results = {
+        'final_combined_table': final_combined_table
+    }
+    if final_table is not None:
+        results['final_table'] = final_table
     with open(save_path, 'wb') as f:
-        pickle.dump({
-            'final_combined_table': final_combined_table
-        }, f)
+        pickle.dump(results, f)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,359 @@
+# --- Header -------------------------------------------------------------------
+# Out-of-core engine: prepare and analysis as lazy DuckDB query plans over the data files
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import os
+
+import numpy as np
+import pandas as pd
+from instrument import record, stage
+from results_store import finish_results_store, start_results_store
+from storage import storage_format
+from utils import setup_logging
+
+log = setup_logging()
+
+
+def connect(cfg):
+    '''
+    Opens an in-memory DuckDB database with the memory cap, threads and spill directory of the config.
+
+    Operators that do not fit into duckdb_memory_limit spill to duckdb_temp_dir, so the
+    data files can be larger than the memory.
+    '''
+    import duckdb
+
+    os.makedirs(cfg['duckdb_temp_dir'], exist_ok=True)
+    connection = duckdb.connect()
+    connection.execute(f"SET memory_limit = '{cfg['duckdb_memory_limit']}'")
+    connection.execute(f"SET threads = {int(cfg['duckdb_threads'])}")
+    connection.execute(f"SET temp_directory = '{cfg['duckdb_temp_dir']}'")
+    # The views order their results explicitly, which lets the scans and aggregations run out of order
+    connection.execute("SET preserve_insertion_order = false")
+    # NaN compares larger than every number in DuckDB, pandas skips it like a missing value
+    connection.execute("CREATE MACRO nan_to_null(x) AS CASE WHEN isnan(x) THEN NULL ELSE x END")
+    return connection
+
+
+def scan(path):
+    '''
+    Returns the table function that reads a parquet file or a glob of parquet files.
+    '''
+    if storage_format(path) != 'parquet':
+        raise ValueError(f"The duckdb engine reads parquet files, not {path}")
+    return f"read_parquet('{path}')"
+
+
+def create_prepare_views(connection, source, key_vars, min_obs=300, min_years=3, rule='legacy_window'):
+    '''
+    Defines the preparation as views: duplicate removal, the country filter and the firm filter.
+
+    The views follow prepare_data.prepare_financial_data. The first of duplicate firm-years
+    in file order is kept, countries need min_obs observations of every key variable, and
+    firms need complete key variables in min_years consecutive years by the given rule,
+    as in filter_firms. Nothing is read until a view is queried.
+    '''
+    if rule not in ('run', 'legacy_window'):
+        raise ValueError(f"Unknown consecutive years rule {rule!r}, use 'run' or 'legacy_window'")
+    complete = ' AND '.join(f"{var} IS NOT NULL" for var in key_vars)
+    # Rows are numbered in file order: by file, in the sorted order of a glob, and by row within the file
+    connection.execute(f"""
+        CREATE VIEW pulled AS
+        SELECT *, (file_index::BIGINT << 40) + file_row_number AS row_key FROM {scan(source)}
+    """)
+    # The filters only need the keys, the country and the key variables of the first row of every
+    # firm-year, so the windows run on these columns and the full rows are only read for the output
+    connection.execute(f"""
+        CREATE VIEW deduplicated AS
+        SELECT row_key, item6105, year_, item6026, {', '.join(key_vars)}
+        FROM pulled
+        QUALIFY row_number() OVER (PARTITION BY item6105, year_ ORDER BY row_key) = 1
+    """)
+    connection.execute(f"""
+        CREATE VIEW country_coverage AS
+        SELECT item6026, {', '.join(f"count({var}) AS {var}" for var in key_vars)},
+            {' AND '.join(f"count({var}) >= {min_obs}" for var in key_vars)} AS included
+        FROM deduplicated WHERE item6026 IS NOT NULL GROUP BY item6026
+    """)
+    connection.execute(f"""
+        CREATE VIEW complete_firm_years AS
+        SELECT row_key, item6105, year_ FROM deduplicated
+        WHERE {complete} AND item6026 IN (SELECT item6026 FROM country_coverage WHERE included)
+    """)
+    if rule == 'run':
+        # The firm-years are unique, so the years of a run of consecutive years share year_ - row_number()
+        qualifying_firms = f"""
+        SELECT DISTINCT item6105 FROM (
+            SELECT item6105, year_ - row_number() OVER (PARTITION BY item6105 ORDER BY year_) AS run
+            FROM complete_firm_years
+        )
+        GROUP BY item6105, run HAVING count(*) >= {min_years}
+        """
+    else:
+        qualifying_firms = f"""
+        WITH steps AS (
+            SELECT item6105, year_,
+                row_number() OVER firm - 1 AS position_in_firm,
+                coalesce(year_ - lag(year_) OVER firm = 1, false)::INTEGER AS one_year_step
+            FROM complete_firm_years
+            WINDOW firm AS (PARTITION BY item6105 ORDER BY year_)
+        ),
+        windows AS (
+            SELECT item6105, position_in_firm,
+                sum(one_year_step) OVER (
+                    PARTITION BY item6105 ORDER BY year_ ROWS BETWEEN {min_years - 1} PRECEDING AND CURRENT ROW
+                ) AS window_steps
+            FROM steps
+        )
+        SELECT DISTINCT item6105 FROM windows
+        WHERE position_in_firm >= {min_years - 1} AND window_steps >= {min_years - 1}
+        """
+    connection.execute(f"CREATE VIEW qualifying_firms AS {qualifying_firms}")
+    connection.execute("""
+        CREATE VIEW prepared AS
+        SELECT pulled.* EXCLUDE (row_key)
+        FROM pulled
+        SEMI JOIN (
+            SELECT row_key FROM complete_firm_years
+            WHERE item6105 IN (SELECT item6105 FROM qualifying_firms)
+        ) AS kept USING (row_key)
+        ORDER BY pulled.row_key
+    """)
+
+
+def prepare_financial_data_lazy(cfg):
+    '''
+    Runs the preparation on the DuckDB engine and writes the prepared data file.
+
+    Only the counts that are logged and the firm-years per country for Table 1 are
+    brought into pandas. Returns the firm-years per country.
+    '''
+    connection = connect(cfg)
+    try:
+        create_prepare_views(
+            connection, cfg['lazy_source'], cfg['key_vars'], cfg['min_country_obs'], cfg['min_consecutive_years'],
+            cfg['consecutive_years_rule']
+        )
+        with stage('read_table') as step:
+            obs_count, firm_count, dup_count = connection.execute("""
+                SELECT count(*), (SELECT count(*) FROM (SELECT DISTINCT item6105 FROM pulled)),
+                    count(*) - (SELECT count(*) FROM deduplicated)
+                FROM pulled
+            """).fetchone()
+            step['rows_out'] = obs_count
+        log.info(f"Initial number of observations after pulling data: {obs_count}")
+        log.info(f"Initial number of firms after pulling data: {firm_count}")
+        if dup_count:
+            log.warning(f"Removing {dup_count} duplicate firm-year observations.")
+
+        with stage('filter_countries') as step:
+            country_coverage = connection.execute(
+                "SELECT * FROM country_coverage ORDER BY item6026"
+            ).df().set_index('item6026')
+            eliminated_countries = country_coverage.index[~country_coverage['included']].tolist()
+            step['groups_dropped'] = len(eliminated_countries)
+            record(eliminated_countries=eliminated_countries)
+        log.info(f"Firm-year observations with key accounting variables per country:\n{country_coverage.to_string()}")
+        if eliminated_countries:
+            log.info(f"Countries eliminated after filtration: {', '.join(eliminated_countries)}")
+        else:
+            log.info("No countries were eliminated after filtration.")
+
+        # The whole plan runs once here, with the result streamed into the prepared data file
+        path = cfg['prepared_data_save_path']
+        with stage('write_prepared') as step:
+            connection.execute(f"COPY (SELECT * FROM prepared) TO '{path}' (FORMAT {storage_format(path)})")
+            country_counts = connection.execute(f"""
+                SELECT item6026 AS "Country", count(*) AS "# Firm-years"
+                FROM {scan(path)} GROUP BY item6026 ORDER BY item6026
+            """).df()
+            final_firm_count = connection.execute(f"SELECT count(DISTINCT item6105) FROM {scan(path)}").fetchone()[0]
+            step['rows_out'] = int(country_counts['# Firm-years'].sum())
+        log.info(f"Number of observations after preparation: {step['rows_out']}")
+        log.info(f"Number of firms after preparation: {final_firm_count}")
+        return country_counts
+    finally:
+        connection.close()
+
+
+def create_em_views(connection, source):
+    '''
+    Defines the firm-level inputs of EM1-EM4 as in do_analysis.build_em_panel and their
+    firm-year values as in em1_values to em4_flags.
+
+    Lags and changes are taken from the previous year within each firm and the standard
+    deviations over all years of a firm. As in pandas, a division by zero gives an infinite
+    value and an undefined ratio is treated as missing.
+    '''
+    connection.execute(f"""
+        CREATE VIEW em_panel AS
+        WITH changes AS (
+            SELECT item6105, year_, item6026, item1651, item1250, item1151,
+                item2201 - lag(item2201) OVER firm AS delta_CA,
+                item2003 - lag(item2003) OVER firm AS delta_Cash,
+                item3101 - lag(item3101) OVER firm AS delta_CL,
+                coalesce(item3051 - lag(item3051) OVER firm, 0) AS delta_STD,
+                coalesce(item3063 - lag(item3063) OVER firm, 0) AS delta_TP,
+                lag(item2999) OVER firm AS lagged_total_assets
+            FROM read_parquet('{source}')
+            WINDOW firm AS (PARTITION BY item6105 ORDER BY year_)
+        ),
+        accruals AS (
+            SELECT *, (delta_CA - delta_Cash) - (delta_CL - delta_STD - delta_TP) - item1151 AS Accruals
+            FROM changes
+        ),
+        cfo AS (
+            SELECT *, item1250 - Accruals AS CFO FROM accruals
+        )
+        SELECT item6105, year_, item6026, item1651, Accruals, CFO,
+            stddev_samp(item1250) OVER (PARTITION BY item6105) AS std_operating_income,
+            stddev_samp(CFO) OVER (PARTITION BY item6105) AS std_cfo,
+            lagged_total_assets,
+            Accruals - lag(Accruals) OVER firm AS delta_Accruals,
+            CFO - lag(CFO) OVER firm AS delta_CFO
+        FROM cfo
+        WINDOW firm AS (PARTITION BY item6105 ORDER BY year_)
+    """)
+    connection.execute("""
+        CREATE VIEW em_values AS
+        SELECT item6026,
+            nan_to_null((std_operating_income / lagged_total_assets) / (std_cfo / lagged_total_assets)) AS EM1,
+            delta_Accruals / lagged_total_assets AS scaled_delta_Accruals,
+            delta_CFO / lagged_total_assets AS scaled_delta_CFO,
+            nan_to_null(abs(Accruals) / abs(CFO)) AS EM3,
+            nan_to_null(item1651 / lagged_total_assets) AS scaled_net_earnings
+        FROM em_panel
+    """)
+
+
+def country_em_queries(profit_band=0.01):
+    '''
+    Returns the per-country aggregations of the firm-year values: the medians for EM1 and
+    EM3 with the small profit and loss counts for EM4, and the Spearman correlation for EM2.
+    '''
+    medians_and_counts = f"""
+        SELECT item6026, median(EM1) AS EM1, median(EM3) AS EM3,
+            count_if(scaled_net_earnings >= 0 AND scaled_net_earnings <= {profit_band}) AS small_profits,
+            count_if(scaled_net_earnings >= -{profit_band} AND scaled_net_earnings < 0) AS small_losses
+        FROM em_values GROUP BY item6026 ORDER BY item6026
+    """
+    # Average ranks for ties within each country, as in panel.grouped_spearman
+    spearman = """
+        WITH valid AS (
+            SELECT item6026, scaled_delta_Accruals AS x, scaled_delta_CFO AS y FROM em_values
+            WHERE isfinite(scaled_delta_Accruals) AND isfinite(scaled_delta_CFO)
+        ),
+        ranks AS (
+            SELECT item6026,
+                rank() OVER (PARTITION BY item6026 ORDER BY x) + (count(*) OVER (PARTITION BY item6026, x) - 1) / 2 AS rank_x,
+                rank() OVER (PARTITION BY item6026 ORDER BY y) + (count(*) OVER (PARTITION BY item6026, y) - 1) / 2 AS rank_y
+            FROM valid
+        )
+        SELECT countries.item6026, corr(rank_x, rank_y) AS EM2
+        FROM (SELECT DISTINCT item6026 FROM em_panel) AS countries
+        LEFT JOIN ranks ON countries.item6026 = ranks.item6026
+        GROUP BY countries.item6026 ORDER BY countries.item6026
+    """
+    return medians_and_counts, spearman
+
+
+def calculate_em_lazy(cfg):
+    '''
+    Calculates the country tables and summary statistics of EM1-EM4 on the DuckDB engine.
+
+    Only the per-country results are brought into pandas, where they are rounded and EM4 is
+    restricted to the countries with at least em4_min_small_losses small losses, as in
+    calculate_em1 to calculate_em4. Returns the four (country table, summary statistics) pairs.
+    '''
+    connection = connect(cfg)
+    try:
+        create_em_views(connection, cfg['prepared_data_save_path'])
+        medians_and_counts, spearman = country_em_queries(cfg['em4_profit_band'])
+        with stage('country_em_medians_and_counts') as step:
+            country_stats = connection.execute(medians_and_counts).df()
+            step['rows_out'] = len(country_stats)
+        with stage('country_em2') as step:
+            country_em2 = connection.execute(spearman).df()
+            step['rows_out'] = len(country_em2)
+    finally:
+        connection.close()
+
+    country_em1 = country_stats[['item6026', 'EM1']].copy()
+    country_em3 = country_stats[['item6026', 'EM3']].copy()
+    eligible = country_stats['small_losses'] >= cfg['em4_min_small_losses']
+    country_em4 = pd.DataFrame({
+        'item6026': country_stats['item6026'][eligible],
+        'EM4': country_stats['small_profits'][eligible] / np.maximum(1, country_stats['small_losses'][eligible]),
+    }).reset_index(drop=True)
+
+    excluded_countries = len(country_stats) - len(country_em4)
+    log.info(
+        f"{excluded_countries} countries were excluded due to having fewer than "
+        f"{cfg['em4_min_small_losses']} small losses."
+    )
+    results = []
+    for metric, country_em in zip(['EM1', 'EM2', 'EM3', 'EM4'], [country_em1, country_em2, country_em3, country_em4]):
+        country_em[metric] = country_em[metric].astype('float64').round(3)
+        summary_stats = country_em[metric].agg(['mean', 'median', 'std', 'min', 'max']).round(3)
+        results.append((country_em, summary_stats))
+    return results
+
+
+def write_results_store_lazy(cfg, path, key=None):
+    '''
+    Writes the firm-year results store on the DuckDB engine, as write_results_store does
+    for the results of do_analysis.firm_year_results.
+
+    The firm-year values are streamed from the prepared data file into the partition
+    directories by one COPY, and only the firm index, one row per firm, is brought into
+    memory. Undefined ratios are stored as missing and the small profit and loss flags of
+    firm-years without scaled net earnings as false, as in pandas.
+    '''
+    profit_band = cfg['em4_profit_band']
+    connection = connect(cfg)
+    try:
+        create_em_views(connection, cfg['prepared_data_save_path'])
+        tmp_path = start_results_store(path)
+        with stage('write_results_store') as step:
+            # The rows are sorted by firm within each file, so the order of the query has to be kept
+            connection.execute("SET preserve_insertion_order = true")
+            connection.execute(f"""
+                COPY (
+                    WITH scaled AS (
+                        SELECT *,
+                            nan_to_null((std_operating_income / lagged_total_assets) / (std_cfo / lagged_total_assets)) AS EM1,
+                            nan_to_null(abs(Accruals) / abs(CFO)) AS EM3,
+                            nan_to_null(delta_Accruals / lagged_total_assets) AS scaled_delta_Accruals,
+                            nan_to_null(delta_CFO / lagged_total_assets) AS scaled_delta_CFO,
+                            nan_to_null(item1651 / lagged_total_assets) AS scaled_net_earnings
+                        FROM em_panel
+                    )
+                    SELECT item6105::VARCHAR AS item6105, item6026::VARCHAR AS item6026, year_::INTEGER AS year_,
+                        Accruals, CFO, lagged_total_assets, std_operating_income, std_cfo, delta_Accruals, delta_CFO,
+                        EM1, EM3, scaled_delta_Accruals, scaled_delta_CFO,
+                        coalesce(scaled_net_earnings >= 0 AND scaled_net_earnings <= {profit_band}, false) AS small_profits,
+                        coalesce(scaled_net_earnings >= -{profit_band} AND scaled_net_earnings < 0, false) AS small_losses,
+                        scaled_net_earnings
+                    FROM scaled
+                    ORDER BY item6026, year_, item6105
+                ) TO '{tmp_path}' (
+                    FORMAT parquet, PARTITION_BY (item6026, year_),
+                    ROW_GROUP_SIZE {int(cfg['results_store_row_group_rows'])}
+                )
+            """)
+            firm_index = connection.execute(f"""
+                SELECT item6105, min(item6026) AS item6026, min(year_)::SMALLINT AS first_year, max(year_)::SMALLINT AS last_year
+                FROM read_parquet('{tmp_path}/**/*.parquet', hive_partitioning = true)
+                GROUP BY item6105 ORDER BY item6105
+            """).df()
+            rows = connection.execute(
+                f"SELECT count(*) FROM read_parquet('{tmp_path}/**/*.parquet', hive_partitioning = true)"
+            ).fetchone()[0]
+            step['rows_out'] = rows
+    finally:
+        connection.close()
+
+    finish_results_store(firm_index, tmp_path, path, key)
+    log.info(f"Results store with {rows} firm-years of {len(firm_index)} firms saved to {path}")
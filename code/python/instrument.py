@@ -0,0 +1,259 @@
+# --- Header -------------------------------------------------------------------
+# Per-stage instrumentation: timings, peak memory and row counts as JSON metrics
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import cProfile
+import functools
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+from utils import setup_logging
+
+log = setup_logging()
+
+
+class StageRecorder:
+    '''
+    Collects the metrics of the pipeline stages of one run.
+
+    Stages are only measured after start() was called, so instrumented functions cost
+    nothing extra when they are called from the sweep, the bootstrap or the benchmark.
+    Stages can be nested. Every stage records its parent, the wall and CPU time, the peak
+    of the traced memory above the memory at its start, the peak RSS of the process, the
+    rows in and out and the groups dropped. With profile, every top-level stage runs under
+    cProfile and its statistics are saved to profile_dir, numbered per stage name, so a
+    stage that runs several times, such as raw_sql during a pull, keeps every profile.
+
+    Every thread has its own stack of running stages, so stages that run in parallel
+    threads are recorded side by side. Their traced memory peaks overlap, because
+    tracemalloc traces the whole process.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = []
+        self.local = threading.local()
+        self.profile_counts = {}
+        self.profile_lock = threading.Lock()
+
+    @property
+    def stack(self):
+        '''
+        The stages running in the current thread, the innermost last.
+        '''
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def start(self, trace_memory=True, profile=False, profile_dir=None):
+        self.enabled = True
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.started = pd.Timestamp.now().isoformat()
+        self.stages = []
+        self.local = threading.local()
+        self.profile_counts = {}
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        '''
+        Measures the code in the with block as one stage.
+
+        Yields the stage record, so the block can set rows_out, groups_dropped or details.
+        '''
+        if not self.enabled:
+            yield {'details': {}}
+            return
+
+        record = {
+            'stage': name,
+            'parent': self.stack[-1]['stage'] if self.stack else None,
+            'rows_in': rows_in,
+            'rows_out': None,
+            'groups_dropped': None,
+            'details': {},
+        }
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # The enclosing stage keeps the peak reached so far before the peak is reset for this stage
+            if self.stack:
+                self.stack[-1]['_peak'] = max(self.stack[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+            record['_start_memory'] = current
+            record['_peak'] = current
+
+        profiler = None
+        if self.profile and not self.stack:
+            profiler = cProfile.Profile()
+
+        self.stack.append(record)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall_s'] = time.perf_counter() - start_wall
+            record['cpu_s'] = time.process_time() - start_cpu
+            self.stack.pop()
+
+            record['peak_traced_mb'] = None
+            if self.trace_memory:
+                peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+                record['peak_traced_mb'] = (peak - record.pop('_start_memory')) / 2**20
+                if self.stack:
+                    self.stack[-1]['_peak'] = max(self.stack[-1]['_peak'], peak)
+            record['max_rss_mb'] = max_rss_mb()
+            if profiler is not None:
+                record.update(self.save_profile(name, profiler))
+            self.stages.append(record)
+
+    def save_profile(self, name, profiler, top=15):
+        '''
+        Saves the profile of a stage and returns the functions with the highest cumulative time.
+        '''
+        stats = pstats.Stats(profiler)
+        result = {}
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            with self.profile_lock:
+                sequence = self.profile_counts.get(name, 0)
+                self.profile_counts[name] = sequence + 1
+            result['profile'] = os.path.join(self.profile_dir, f"{name}_{sequence:03d}.prof")
+            stats.dump_stats(result['profile'])
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        result['profile_top'] = [
+            {
+                'function': f"{os.path.basename(file_name)}:{line}({function})",
+                'calls': calls,
+                'total_s': total_time,
+                'cumulative_s': cumulative_time,
+            }
+            for (file_name, line, function), (_, calls, total_time, cumulative_time, _) in entries
+        ]
+        return result
+
+    def record(self, **values):
+        '''
+        Sets values of the innermost running stage, e.g. rows_out or groups_dropped.
+        Values that are not part of the stage record are added to its details.
+        '''
+        if not self.enabled or not self.stack:
+            return
+        for key, value in values.items():
+            if key in ('rows_in', 'rows_out', 'groups_dropped'):
+                self.stack[-1][key] = value
+            else:
+                self.stack[-1]['details'][key] = value
+
+    def write(self, path, **run_info):
+        '''
+        Writes the stage metrics of the run to a JSON file.
+        '''
+        metrics = {
+            'run': {
+                'script': os.path.basename(sys.argv[0]),
+                'started': self.started,
+                'trace_memory': self.trace_memory,
+                'profile': self.profile,
+                **run_info,
+            },
+            'stages': self.stages,
+        }
+        with open(path, 'w') as f:
+            json.dump(metrics, f, indent=2, default=str)
+        log.info(f"Stage metrics saved to {path}")
+
+
+def max_rss_mb():
+    '''
+    Returns the peak resident set size of the process in MB (ru_maxrss is in kilobytes on Linux).
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def count_rows(value):
+    '''
+    Returns the number of rows of a table, or of the first table of a tuple of results.
+    '''
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    return None
+
+
+# Recorder of the running script, shared by all instrumented modules
+recorder = StageRecorder()
+
+
+def stage(name, rows_in=None):
+    '''
+    Context manager that measures a block of code as one stage.
+    '''
+    return recorder.stage(name, rows_in)
+
+
+def record(**values):
+    '''
+    Sets values of the innermost running stage.
+    '''
+    recorder.record(**values)
+
+
+def instrumented(function):
+    '''
+    Decorator that measures each call of the function as one stage.
+
+    The rows in are the rows of the first argument and the rows out are the rows of the
+    result, if these are tables. The function can add more values with record().
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not recorder.enabled:
+            return function(*args, **kwargs)
+        with recorder.stage(function.__name__, count_rows(args[0]) if args else None) as current:
+            result = function(*args, **kwargs)
+            if current['rows_out'] is None:
+                current['rows_out'] = count_rows(result)
+        return result
+    return wrapper
+
+
+def add_metrics_arguments(parser):
+    '''
+    Adds the command line flag to profile the instrumented stages.
+    '''
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Run every top-level stage under cProfile and add the slowest functions to the metrics.'
+    )
+
+
+def start_metrics(cfg, args):
+    '''
+    Starts recording the stage metrics with the settings from the config and the command line.
+    The cProfile statistics are saved next to the metrics file.
+    '''
+    profile_dir = os.path.join(os.path.dirname(cfg['metrics']) or '.', 'profiles')
+    recorder.start(trace_memory=cfg['trace_memory'], profile=args.profile, profile_dir=profile_dir)
@@ -0,0 +1,127 @@
+# --- Header -------------------------------------------------------------------
+# Firm-year panel engine shared by the earnings management metrics
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+
+class FirmPanel:
+    '''
+    Firm-year panel that is sorted once by firm and year.
+
+    The firm boundaries are computed once when the panel is built. Differences, lags
+    and firm-level standard deviations are then computed on contiguous NumPy arrays,
+    without grouping (and hashing) the firm identifier again. Because the panel is
+    sorted by (firm, year), the results do not depend on the input row order.
+    '''
+
+    def __init__(self, df, firm_col='item6105', time_col='year_'):
+        firm_codes, _ = pd.factorize(df[firm_col], sort=True)
+        order = np.lexsort((df[time_col].to_numpy(), firm_codes))
+        self.data = df.iloc[order].reset_index(drop=True)
+
+        sorted_codes = firm_codes[order]
+        self.firm_start = np.ones(len(order), dtype=bool)
+        self.firm_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+        self.starts = np.flatnonzero(self.firm_start)
+        self.firm_index = np.cumsum(self.firm_start) - 1
+        self.n_firms = len(self.starts)
+
+    def values(self, column):
+        '''
+        Returns a column of the sorted panel as a float array.
+        float32 columns stay float32, all other columns are returned as float64.
+        '''
+        return self.data[column].to_numpy(dtype=float_dtype(self.data[column]), na_value=np.nan)
+
+    def lag(self, values):
+        '''
+        Returns the previous year's value within each firm (NaN for a firm's first year).
+        '''
+        values = np.asarray(values, dtype=float_dtype(values))
+        lagged = np.empty_like(values)
+        lagged[0:1] = np.nan
+        lagged[1:] = values[:-1]
+        lagged[self.firm_start] = np.nan
+        return lagged
+
+    def diff(self, values):
+        '''
+        Returns the change from the previous year within each firm (NaN for a firm's first year).
+        '''
+        values = np.asarray(values, dtype=float_dtype(values))
+        return values - self.lag(values)
+
+    def firm_sum(self, values):
+        '''
+        Returns the sum and the number of non-missing values per firm.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        if len(values) == 0:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+        sums = np.add.reduceat(np.where(valid, values, 0.0), self.starts)
+        counts = np.add.reduceat(valid.astype(np.int64), self.starts)
+        return sums, counts
+
+    def firm_std(self, values):
+        '''
+        Returns each firm's sample standard deviation (ddof=1, missing values skipped)
+        broadcast to all of the firm's rows. Firms with fewer than two values get NaN.
+        The sums are accumulated in float64 and the result has the dtype of the values.
+        '''
+        dtype = float_dtype(values)
+        values = np.asarray(values, dtype=np.float64)
+        sums, counts = self.firm_sum(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+            squared_deviations = (values - means[self.firm_index]) ** 2
+            squares, _ = self.firm_sum(squared_deviations)
+            std = np.sqrt(squares / (counts - 1))
+        std[counts < 2] = np.nan
+        return std.astype(dtype, copy=False)[self.firm_index]
+
+
+def float_dtype(values):
+    '''
+    Returns float32 for float32 data and float64 for everything else.
+    '''
+    return np.float32 if values.dtype == np.float32 else np.float64
+
+
+def grouped_spearman(df, group_col, x_col, y_col):
+    '''
+    Computes the Spearman rank correlation between two columns within each group.
+
+    Matches DataFrame.corr(method='spearman') per group: rows where either value is
+    missing or infinite are dropped, values are ranked within the group with average
+    ranks for ties, and the Pearson correlation of the ranks is returned. All groups
+    are reduced at once with grouped sums instead of one correlation matrix per group.
+
+    Returns a Series indexed by group (NaN where the correlation is undefined).
+    '''
+    x = df[x_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    y = df[y_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = np.isfinite(x) & np.isfinite(y)
+    groups = df[group_col][valid]
+
+    ranks = pd.DataFrame({'x': x[valid], 'y': y[valid]}, index=groups.index)
+    ranks = ranks.groupby(groups, observed=True).rank(method='average')
+    counts = groups.groupby(groups, observed=True).transform('size').to_numpy()
+
+    # Average ranks within a group of n values always have mean (n + 1) / 2
+    centered_x = ranks['x'].to_numpy() - (counts + 1) / 2
+    centered_y = ranks['y'].to_numpy() - (counts + 1) / 2
+    moments = pd.DataFrame({
+        'xy': centered_x * centered_y,
+        'xx': centered_x ** 2,
+        'yy': centered_y ** 2,
+    }).groupby(groups.to_numpy(), sort=False).sum()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = moments['xy'] / np.sqrt(moments['xx'] * moments['yy'])
+    all_groups = df[group_col].dropna().drop_duplicates().sort_values()
+    return correlation.reindex(all_groups.to_numpy()).rename_axis(group_col)
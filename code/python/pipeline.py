@@ -0,0 +1,334 @@
+# --- Header -------------------------------------------------------------------
+# Single-process runner of the pull, prepare and analysis stages as a DAG of nodes
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import pickle
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import bootstrap
+import data_source
+import do_analysis
+import panel
+import prepare_data
+import pull_wrds_data
+import results_store
+import sharding
+from cache import StageCache, add_cache_arguments, hash_code, hash_config, hash_frame, open_cache
+from instrument import add_metrics_arguments, recorder, stage, start_metrics
+from storage import apply_schema, combine_partitions, read_table, write_table
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+# Nodes whose data can be saved as a checkpoint with --checkpoint
+CHECKPOINT_NODES = ['pull', 'prepare']
+
+
+class Node:
+    '''
+    One stage of the pipeline.
+
+    The function gets the values of the input nodes and returns the value of the node,
+    which is handed to the nodes that depend on it in memory. The key parts are hashes of
+    the settings and code of the node. Targets are the files the node always writes, and
+    the checkpoint is a file the value is saved to and loaded from on request, with a csv
+    copy if export_csv is set.
+    '''
+
+    def __init__(self, name, inputs, function, key_parts, targets=(), checkpoint=None, export_csv=False):
+        self.name = name
+        self.inputs = inputs
+        self.function = function
+        self.key_parts = key_parts
+        self.targets = list(targets)
+        self.checkpoint = checkpoint
+        self.export_csv = export_csv
+
+
+def main():
+    '''
+    Runs the pull, the preparation, Table 1 and the analysis in one process.
+
+    The data is handed from node to node in memory, so no stage reads the output of the
+    previous stage from disk. Nodes whose key (the hashes of their inputs, settings and
+    code) is unchanged since the last run and whose targets exist are skipped. Nodes that
+    do not depend on each other, such as Table 1 and the EM metrics, run in parallel threads.
+    The pulled and prepared data are only saved when asked for with --checkpoint.
+    '''
+    parser = argparse.ArgumentParser(description='Run the pipeline stages in one process.')
+    parser.add_argument(
+        '--checkpoint', nargs='*', choices=CHECKPOINT_NODES,
+        help='Save the data of these nodes (all if none are given), so later runs can start from it.'
+    )
+    parser.add_argument(
+        '--rerun', nargs='+', default=[], metavar='NODE',
+        help='Run these nodes and the nodes that depend on them even if they are up to date, e.g. to pull new data.'
+    )
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    log.info("Running pipeline ...")
+    cfg = read_config('config/pipeline_cfg.yaml')
+    pull_cfg = read_config('config/pull_data_cfg.yaml')
+    prepare_cfg = read_config('config/prepare_data_cfg.yaml')
+    analysis_cfg = read_config('config/do_analysis_cfg.yaml')
+    if prepare_cfg['engine'] != 'pandas' or analysis_cfg['engine'] != 'pandas':
+        raise ValueError("The pipeline hands the data over in memory and needs engine 'pandas', use the Makefile for 'duckdb'")
+
+    cache = open_cache(analysis_cfg, args)
+    if cache is None:
+        return
+    start_metrics(cfg, args)
+
+    data_hashes = {}
+    nodes = pipeline_nodes(pull_cfg, prepare_cfg, analysis_cfg, cache, data_hashes)
+    checkpoints = [] if args.checkpoint is None else (args.checkpoint or CHECKPOINT_NODES)
+    unknown = set(args.rerun) - {node.name for node in nodes}
+    if unknown:
+        raise ValueError(f"Unknown pipeline nodes: {', '.join(sorted(unknown))}")
+
+    state = load_state(cfg['state_path'])
+    keys = node_keys(nodes)
+    run, load = plan_nodes(nodes, keys, state, checkpoints, args.rerun)
+    skipped = [node.name for node in nodes if node.name not in run and node.name not in load]
+    log.info(f"Nodes to run: {', '.join(node.name for node in nodes if node.name in run) or 'none'}")
+    if load:
+        log.info(f"Nodes loaded from their checkpoint: {', '.join(sorted(load))}")
+    if skipped:
+        log.info(f"Nodes up to date: {', '.join(skipped)}")
+
+    run_nodes(nodes, keys, state, run, load, checkpoints, cfg, data_hashes)
+
+    recorder.write(cfg['metrics'], nodes_run=sorted(run), nodes_loaded=sorted(load), cache=cache.enabled)
+    recorder.stop()
+    log.info("Running pipeline ... Done!")
+
+
+def pipeline_nodes(pull_cfg, prepare_cfg, analysis_cfg, cache, data_hashes):
+    '''
+    Returns the nodes of the pipeline in dependency order.
+
+    The cache keys of the prepare and analysis nodes are built from the hashes of the content
+    of their input data, which run_nodes adds to data_hashes before the nodes run, so changed
+    pulled data misses the cache even if the settings and code are the same.
+    '''
+    def pull():
+        wrds_login = pull_wrds_data.get_wrds_login() if pull_cfg['data_source'] == 'wrds' else None
+        with data_source.open_source(pull_cfg, wrds_login) as source:
+            if pull_cfg['pull_mode'] == 'full':
+                return apply_schema(pull_wrds_data.pull_wrds_data(pull_cfg, source))
+            # The streaming and incremental pulls build the pulled files themselves
+            if pull_cfg['pull_mode'] == 'incremental':
+                pull_wrds_data.pull_wrds_data_incremental(pull_cfg, source)
+                return read_table(pull_cfg['incremental_dir'])
+            partition_paths = pull_wrds_data.pull_wrds_data_streaming(pull_cfg, source)
+            combine_partitions(partition_paths, pull_cfg['worldscope_sample_save_path'])
+        return read_table(pull_cfg['worldscope_sample_save_path'])
+
+    def prepare(wrds_data):
+        cache_key = prepare_data.prepared_data_key(prepare_cfg, data_hashes['pull'])
+        return cache.cached(cache_key, prepare_data.prepare_financial_data, prepare_cfg, wrds_data)
+
+    def table_1(prepared):
+        table = prepare_data.make_table_1(prepared)
+        with open(prepare_cfg['table_1_save_path'], 'wb') as f:
+            pickle.dump({'table_1': table}, f)
+        log.info(f"Table 1 saved to {prepare_cfg['table_1_save_path']}")
+        return table
+
+    def analysis(prepared):
+        return do_analysis.run_analysis(analysis_cfg, cache, prepared, data_hash=data_hashes['prepare'])
+
+    analysis_targets = [analysis_cfg['results']]
+    if analysis_cfg['bootstrap_replicates'] > 0:
+        analysis_targets.append(analysis_cfg['bootstrap_results'])
+    if analysis_cfg['results_store'] is not None:
+        analysis_targets.append(os.path.join(analysis_cfg['results_store'], results_store.FIRM_INDEX_FILE))
+    nodes = [
+        Node(
+            'pull', [], pull,
+            [
+                hash_config(pull_cfg, pull_wrds_data.INCREMENTAL_SIGNATURE_KEYS + ['data_source', 'local_database']),
+                hash_code(pull_wrds_data, data_source),
+            ],
+            checkpoint=pull_cfg['worldscope_sample_save_path'], export_csv=pull_cfg['export_csv'],
+        ),
+        Node(
+            'prepare', ['pull'], prepare,
+            [
+                hash_config(prepare_cfg, ['key_vars', 'min_country_obs', 'min_consecutive_years', 'consecutive_years_rule']),
+                hash_code(prepare_data.prepare_financial_data, prepare_data.filter_countries, prepare_data.filter_firms),
+            ],
+            checkpoint=prepare_cfg['prepared_data_save_path'], export_csv=prepare_cfg['export_csv'],
+        ),
+        Node(
+            'table_1', ['prepare'], table_1,
+            [hash_code(prepare_data.make_table_1, prepare_data.format_table_1)],
+            targets=[prepare_cfg['table_1_save_path']],
+        ),
+        Node(
+            'analysis', ['prepare'], analysis,
+            [hash_config(analysis_cfg, sorted(analysis_cfg)), hash_code(do_analysis, bootstrap, panel, sharding)],
+            targets=analysis_targets,
+        ),
+    ]
+    return nodes
+
+
+def node_keys(nodes):
+    '''
+    Returns the key of every node, built from the keys of its inputs and its own key parts.
+    '''
+    keys = {}
+    for node in nodes:
+        keys[node.name] = StageCache.key(node.name, *[keys[name] for name in node.inputs], *node.key_parts)
+    return keys
+
+
+def plan_nodes(nodes, keys, state, checkpoints, rerun):
+    '''
+    Returns the names of the nodes that have to run and of the nodes that are loaded from their checkpoint.
+
+    A node with targets runs if its key changed since its last run or a target is missing. A
+    node asked to save a checkpoint runs unless its checkpoint is up to date. The inputs of a
+    running node are loaded from an up-to-date checkpoint if there is one and are run otherwise.
+    Nodes in rerun and all nodes that depend on them always run.
+    '''
+    by_name = {node.name: node for node in nodes}
+    forced = set(rerun)
+    for node in nodes:
+        if forced & set(node.inputs):
+            forced.add(node.name)
+
+    def up_to_date(name):
+        return name not in forced and state.get(name, {}).get('key') == keys[name]
+
+    def checkpoint_ready(name):
+        node = by_name[name]
+        return up_to_date(name) and state[name].get('checkpoint', False) and os.path.exists(node.checkpoint)
+
+    run, load = set(), set()
+
+    def schedule(name):
+        if name in run:
+            return
+        run.add(name)
+        load.discard(name)
+        for input_name in by_name[name].inputs:
+            if input_name in run or input_name in load:
+                continue
+            if checkpoint_ready(input_name):
+                load.add(input_name)
+            else:
+                schedule(input_name)
+
+    for node in reversed(nodes):
+        if node.targets and (not up_to_date(node.name) or not all(os.path.exists(path) for path in node.targets)):
+            schedule(node.name)
+        if node.name in checkpoints and not checkpoint_ready(node.name):
+            schedule(node.name)
+    return run, load
+
+
+def run_nodes(nodes, keys, state, run, load, checkpoints, cfg, data_hashes):
+    '''
+    Runs the planned nodes on a thread pool, each as soon as the values of its inputs are available.
+
+    The content of every value that other nodes need is hashed into data_hashes in the pool,
+    and the hash is kept in the state, so a run reports whether the data of a node changed
+    since its last run. Checkpoints are saved in the pool as well, next to the nodes that
+    continue with the data. The value of a node is released when all nodes that need it are
+    done. The state file is updated after every node, so an interrupted run keeps the nodes
+    that finished.
+    '''
+    by_name = {node.name: node for node in nodes}
+    pending = [node.name for node in nodes if node.name in run or node.name in load]
+    consumers = {name: 0 for name in pending}
+    for name in run:
+        for input_name in by_name[name].inputs:
+            consumers[input_name] += 1
+    hashed = {name for name in pending if consumers[name] > 0}
+    values = {}
+
+    def execute(name):
+        node = by_name[name]
+        if name in load:
+            log.info(f"Loading {name} from {node.checkpoint} ...")
+            value = read_table(node.checkpoint)
+        else:
+            log.info(f"Running node {name} ...")
+            with stage(name):
+                value = node.function(*[values[input_name] for input_name in node.inputs])
+            log.info(f"Running node {name} ... Done!")
+        return value, hash_frame(value) if name in hashed else None
+
+    def release(name):
+        consumers[name] -= 1
+        if consumers[name] <= 0:
+            values.pop(name, None)
+
+    with ThreadPoolExecutor(max_workers=cfg['workers']) as pool:
+        futures = {}
+        while pending or futures:
+            for name in list(pending):
+                if all(input_name in values for input_name in by_name[name].inputs) or name in load:
+                    futures[pool.submit(execute, name)] = ('node', name)
+                    pending.remove(name)
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, name = futures.pop(future)
+                value = future.result()
+                if kind == 'checkpoint':
+                    state[name]['checkpoint'] = True
+                    log.info(f"Checkpoint of {name} saved to {by_name[name].checkpoint}")
+                    release(name)
+                    save_state(state, cfg['state_path'])
+                    continue
+
+                values[name], data_hash = value
+                if data_hash is not None:
+                    data_hashes[name] = data_hash
+                if name in run:
+                    if data_hash is not None and name in state and 'data_hash' in state[name]:
+                        changed = state[name]['data_hash'] != data_hash
+                        log.info(f"Data of {name} {'changed' if changed else 'unchanged'} since its last run")
+                    state[name] = {'key': keys[name], 'checkpoint': False, 'data_hash': data_hash}
+                    save_state(state, cfg['state_path'])
+                    if name in checkpoints:
+                        consumers[name] += 1
+                        node = by_name[name]
+                        futures[pool.submit(write_table, values[name], node.checkpoint, node.export_csv)] = ('checkpoint', name)
+                for input_name in by_name[name].inputs if name in run else []:
+                    release(input_name)
+                if consumers[name] == 0:
+                    values.pop(name)
+
+
+def load_state(path):
+    '''
+    Returns the keys, checkpoints and data hashes of the nodes at their last run, or an empty state.
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path):
+    '''
+    Writes the state of the nodes, replacing the previous state file at once.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    main()
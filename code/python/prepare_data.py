@@ -4,30 +4,99 @@
 # (C) Melisa Mazaeva -  See LICENSE file for details
 # ------------------------------------------------------------------------------
 
+import argparse
+import numpy as np
 import pandas as pd
 import pickle
+from cache import StageCache, add_cache_arguments, hash_code, hash_config, hash_file, open_cache
+from duckdb_engine import prepare_financial_data_lazy
+from instrument import add_metrics_arguments, instrumented, record, recorder, stage, start_metrics
+from storage import read_table, write_table
 from utils import read_config, setup_logging
 
 log = setup_logging()
 def main():
+    parser = argparse.ArgumentParser(description='Prepare the pulled data for the analysis.')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
     log.info("Preparing data for analysis ...")
     cfg = read_config('config/prepare_data_cfg.yaml')
+    cache = open_cache(cfg, args)
+    if cache is None:
+        return
+    start_metrics(cfg, args)
+
+    if cfg['engine'] == 'duckdb':
+        # The duckdb engine writes the prepared data itself and returns the firm-years per country
+        table_1 = format_table_1(prepare_financial_data_lazy(cfg))
+        log.info("Preparing data for analysis ... Done!")
+    else:
+        # Prepare the pulled data, unless the same data was already prepared with the same settings and code
+        cache_key = prepared_data_key(cfg, hash_file(cfg['worldscope_sample_save_path']))
+        filtered_firms_data = cache.cached(cache_key, prepare_financial_data, cfg)
+
+        # Save the filtered dataset
+        write_table(filtered_firms_data, cfg['prepared_data_save_path'], export_csv=cfg['export_csv'])
+
+        log.info("Preparing data for analysis ... Done!")
 
+        # Generate summary table for firm-year observations per country
+        table_1 = make_table_1(filtered_firms_data)
+
+    # Save Table 1 to a pickle file
+    results = {
+        "table_1": table_1
+    }
+    with open(cfg['table_1_save_path'], 'wb') as f:
+        pickle.dump(results, f)
+    
+    log.info(f"Table 1 saved to {cfg['table_1_save_path']}")
+
+    # Save the timings, memory and sample attrition of the stages that were computed in this run
+    recorder.write(cfg['metrics'], cache=cache.enabled)
+    recorder.stop()
+
+def prepared_data_key(cfg, data_hash):
+    '''
+    Returns the cache key of the prepared data for the hash of the pulled data.
+    '''
+    return StageCache.key(
+        'prepared_data',
+        data_hash,
+        hash_config(cfg, ['key_vars', 'min_country_obs', 'min_consecutive_years', 'consecutive_years_rule']),
+        hash_code(prepare_financial_data, filter_countries, filter_firms, read_table),
+    )
+
+def prepare_financial_data(cfg, wrds_data=None):
+    '''
+    Loads the pulled data, removes duplicate firm-years and applies the country and firm filters.
+    Pulled data that is already in memory can be passed as wrds_data instead of being loaded.
+    '''
     # Load the pulled data
-    wrds_data = pd.read_csv(cfg['worldscope_sample_save_path'])
+    if wrds_data is None:
+        with stage('read_table') as step:
+            wrds_data = read_table(cfg['worldscope_sample_save_path'])
+            step['rows_out'] = len(wrds_data)
     initial_obs_count_pulled = len(wrds_data)
     initial_firm_count_pulled = len(wrds_data['item6105'].unique())
     log.info(f"Initial number of observations after pulling data: {initial_obs_count_pulled}")
     log.info(f"Initial number of firms after pulling data: {initial_firm_count_pulled}")
 
     # Check for duplicate firm-year observations
-    dup_obs = wrds_data[wrds_data.duplicated(subset=['item6105', 'year_'], keep=False)]
-    if not dup_obs.empty:
-        log.warning(f"Found {dup_obs.shape[0]} duplicate firm-year observations. Removing duplicates.")
-        wrds_data = wrds_data.drop_duplicates(subset=['item6105', 'year_'], keep='first')
+    with stage('drop_duplicates', rows_in=len(wrds_data)) as step:
+        dup_obs = wrds_data[wrds_data.duplicated(subset=['item6105', 'year_'], keep=False)]
+        if not dup_obs.empty:
+            log.warning(f"Found {dup_obs.shape[0]} duplicate firm-year observations. Removing duplicates.")
+            wrds_data = wrds_data.drop_duplicates(subset=['item6105', 'year_'], keep='first')
+        step['rows_out'] = len(wrds_data)
 
     # Filter countries with at least 300 firm-year observations for key accounting variables as in paper
-    filtered_countries_data, eliminated_countries = filter_countries(wrds_data)
+    filtered_countries_data, eliminated_countries, country_coverage = filter_countries(
+        wrds_data, cfg['key_vars'], cfg['min_country_obs']
+    )
+    log.info(f"Firm-year observations with key accounting variables per country:\n{country_coverage.to_string()}")
 
     # Print eliminated countries
     if eliminated_countries:
@@ -39,7 +108,9 @@ def main():
     initial_firm_count = len(filtered_countries_data['item6105'].unique())
     initial_obs_count = len(filtered_countries_data)
     
-    filtered_firms_data = filter_firms(filtered_countries_data)
+    filtered_firms_data = filter_firms(
+        filtered_countries_data, cfg['key_vars'], cfg['min_consecutive_years'], cfg['consecutive_years_rule']
+    )
 
     final_firm_count = len(filtered_firms_data['item6105'].unique())
     final_obs_count = len(filtered_firms_data)
@@ -53,15 +124,20 @@ def main():
     log.info(f"Number of observations after preparation: {final_obs_count}")
     log.info(f"Number of firms after preparation: {final_firm_count}")
 
-    # Save the filtered dataset
-    filtered_firms_data.to_csv(cfg['prepared_data_save_path'], index=False)
-
-    log.info("Preparing data for analysis ... Done!")
+    return filtered_firms_data
 
-    # Generate summary table for firm-year observations per country
-    summary_table = filtered_firms_data.groupby('item6026').size().reset_index(name='# Firm-years')
+def make_table_1(filtered_firms_data):
+    '''
+    Builds Table 1 with the number of firm-years per country and summary statistics.
+    '''
+    summary_table = filtered_firms_data.groupby('item6026', observed=True).size().reset_index(name='# Firm-years')
     summary_table.columns = ['Country', '# Firm-years']
-    
+    return format_table_1(summary_table)
+
+def format_table_1(summary_table):
+    '''
+    Adds the summary statistics to the firm-years per country and formats Table 1.
+    '''
     # Compute mean, median, min, and max
     summary_stats = summary_table['# Firm-years'].describe()[['mean', '50%', 'min', 'max']]
     summary_stats.index = ['Mean', 'Median', 'Min', 'Max']
@@ -77,33 +153,85 @@ def main():
     # Insert an empty row after index 30
     empty_row = pd.DataFrame([['', '']], columns=table_1.columns)
     table_1_with_blank = pd.concat([table_1.iloc[:31], empty_row, table_1.iloc[31:]], ignore_index=True)
-    
-    # Save Table 1 to a pickle file
-    results = {
-        "table_1": table_1_with_blank
-    }
-    with open(cfg['table_1_save_path'], 'wb') as f:
-        pickle.dump(results, f)
-    
-    log.info(f"Table 1 saved to {cfg['table_1_save_path']}")
-
-def filter_countries(df):
-    key_vars = ['item2999', 'item1001', 'item1250', 'item1651']  # Total Assets, Net Sales, Operating Income, Net Income
-    grouped = df.groupby('item6026')
-    country_filter = grouped.filter(lambda x: all(x[key_vars].count() >= 300))
-    eliminated_countries = set(df['item6026'].unique()) - set(country_filter['item6026'].unique())
-    return country_filter, list(eliminated_countries)
-
-def filter_firms(df):
-    key_vars = ['item2999', 'item1001', 'item1250', 'item1651']
-    df = df.dropna(subset=key_vars)
-    
-    def has_three_consecutive_years(group):
-        group = group.sort_values('year_')
-        consecutive_years = (group['year_'].diff() == 1).astype(int).rolling(window=3).sum()
-        return (consecutive_years >= 2).any()
-
-    firm_filter = df.groupby('item6105').filter(has_three_consecutive_years)
+    return table_1_with_blank
+
+@instrumented
+def filter_countries(df, key_vars, min_obs=300):
+    '''
+    Keeps countries with at least min_obs non-missing observations for every key variable.
+
+    The non-missing counts are computed in one grouped count and the countries are
+    selected with a single boolean mask, without building per-country sub-frames.
+
+    Returns the filtered data, the list of eliminated countries and the coverage report
+    with the counts per country and key variable and whether the country is included.
+    '''
+    country_coverage = df.groupby('item6026', observed=True)[key_vars].count()
+    country_coverage['included'] = (country_coverage[key_vars] >= min_obs).all(axis=1)
+
+    included_countries = country_coverage.index[country_coverage['included']]
+    country_filter = df[df['item6026'].isin(included_countries)]
+    eliminated_countries = country_coverage.index[~country_coverage['included']].tolist()
+    record(groups_dropped=len(eliminated_countries), eliminated_countries=eliminated_countries)
+    return country_filter, eliminated_countries, country_coverage
+
+@instrumented
+def filter_firms(df, key_vars, min_years=3, rule='legacy_window'):
+    '''
+    Keeps firms with complete key variables in min_years consecutive years.
+
+    With the default rule 'legacy_window' a firm qualifies if any min_years consecutive
+    observations contain at least min_years - 1 steps of exactly one year, counting the
+    step into the first observation. This is the rule of the previous per-firm
+    rolling-window filter and gives the same firms. It also keeps firms without a run of
+    min_years years, e.g. 1990-91 and 1993-94 for three years. With rule 'run' a firm
+    qualifies if its longest run of consecutive years is at least min_years long, which
+    changes the sample.
+
+    The check is vectorized: the data is sorted once by (item6105, year_) and the run
+    positions and the one-year steps per window are taken from cumulative operations
+    over the whole panel.
+    '''
+    if rule not in ('run', 'legacy_window'):
+        raise ValueError(f"Unknown consecutive years rule {rule!r}, use 'run' or 'legacy_window'")
+
+    # Only firm-years with all key variables count, firms without any of them are dropped
+    complete = df[key_vars].notna().all(axis=1).to_numpy()
+    all_firm_codes, firm_ids = pd.factorize(df['item6105'])
+    firm_codes = all_firm_codes[complete]
+
+    # Sort once by firm and year using integer firm codes
+    years = df['year_'].to_numpy()[complete]
+    order = np.lexsort((years, firm_codes))
+    sorted_codes = firm_codes[order]
+    sorted_years = years[order]
+
+    # Mark the first observation of each firm and the position of each row within its firm
+    n = len(order)
+    positions = np.arange(n)
+    firm_start = np.ones(n, dtype=bool)
+    firm_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    position_in_firm = positions - np.maximum.accumulate(np.where(firm_start, positions, 0))
+
+    # Flag one-year steps within a firm
+    one_year_step = np.zeros(n, dtype=np.int64)
+    one_year_step[1:] = (np.diff(sorted_years) == 1) & ~firm_start[1:]
+
+    if rule == 'run':
+        # The position of each row within its run of consecutive years, a run ends at the first gap
+        position_in_run = positions - np.maximum.accumulate(np.where(one_year_step == 0, positions, 0))
+        qualifying_rows = position_in_run >= min_years - 1
+    else:
+        # Count the one-year steps over windows of min_years rows
+        cumulative_steps = np.cumsum(one_year_step)
+        window_steps = cumulative_steps.copy()
+        window_steps[min_years:] -= cumulative_steps[:-min_years]
+        qualifying_rows = (position_in_firm >= min_years - 1) & (window_steps >= min_years - 1)
+
+    qualifying_firms = np.zeros(len(firm_ids), dtype=bool)
+    qualifying_firms[sorted_codes[qualifying_rows]] = True
+    record(groups_dropped=int(len(firm_ids) - qualifying_firms.sum()))
+    firm_filter = df[complete & qualifying_firms[all_firm_codes]]
     return firm_filter
 
 if __name__ == "__main__":
@@ -3,28 +3,82 @@
 #
 # This code pulls data from WRDS Worldscope Database
 # ------------------------------------------------------------------------------
+import argparse
+import hashlib
+import json
 import os
+import shutil
+import sys
+import zlib
 from getpass import getpass
 import dotenv
 
+import numpy as np
 import pandas as pd
+from data_source import open_source
+from instrument import add_metrics_arguments, instrumented, record, recorder, start_metrics
+from storage import apply_schema, combine_partitions, read_table, write_table
 from utils import read_config, setup_logging
-import wrds
 
 log = setup_logging()
 
+# Configuration entries that determine the content of the pulled partitions
+PARTITION_SIGNATURE_KEYS = [
+    'dyn_vars', 'stat_vars', 'cs_filter', 'included_countries', 'excluded_countries',
+    'filter_location', 'pull_mode', 'chunk_rows'
+]
+# Configuration entries that determine which firm-years the incremental pull keeps
+INCREMENTAL_SIGNATURE_KEYS = ['dyn_vars', 'stat_vars', 'cs_filter', 'included_countries', 'excluded_countries']
+# Columns of the firm-year watermarks of the incremental pull
+WATERMARK_COLUMNS = ['item6105', 'year_', 'item5350']
+
 def main():
     '''
     Main function to pull data from WRDS.
 
     This function reads the configuration file, gets the WRDS login credentials, and pulls the data from WRDS.
+    With data_source 'local' the data is pulled from the local database instead, which needs no login.
+
+    The data is then saved to a parquet (or csv) file, selected by the extension of the save path.
+    In the streaming pull modes the data is first written partition by partition and then combined.
+    In the incremental pull mode only new or changed firm-years are pulled and upserted into the firm
+    buckets in incremental_dir, which the later stages read instead of the pulled file.
 
-    The data is then saved to a csv file.
+    With --check-pushdown the data is pulled once with the filters in SQL and once with the filters
+    in pandas, and the two results are compared instead of saved. The script exits with status 1
+    if they differ.
     '''
+    parser = argparse.ArgumentParser(description='Pull Worldscope data from WRDS.')
+    parser.add_argument('--check-pushdown', action='store_true',
+                        help='Check that SQL and pandas filtering return the same rows.')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
     cfg = read_config('config/pull_data_cfg.yaml')
-    wrds_login = get_wrds_login()
-    wrds_data = pull_wrds_data(cfg, wrds_login)
-    wrds_data.to_csv(cfg['worldscope_sample_save_path'], index=False)
+    wrds_login = get_wrds_login() if cfg['data_source'] == 'wrds' else None
+    start_metrics(cfg, args)
+
+    # One connection is opened for the run and shared by all queries
+    pushdown_ok = True
+    with open_source(cfg, wrds_login) as source:
+        if args.check_pushdown:
+            pushdown_ok = check_filter_pushdown(cfg, source)
+        elif cfg['pull_mode'] == 'full':
+            wrds_data = pull_wrds_data(cfg, source)
+            write_table(wrds_data, cfg['worldscope_sample_save_path'], export_csv=cfg['export_csv'])
+        elif cfg['pull_mode'] == 'incremental':
+            pull_wrds_data_incremental(cfg, source)
+        else:
+            partition_paths = pull_wrds_data_streaming(cfg, source)
+            combine_partitions(partition_paths, cfg['worldscope_sample_save_path'], export_csv=cfg['export_csv'])
+
+    # Save the timings and row counts of the queries and streamed chunks
+    recorder.write(cfg['metrics'], data_source=cfg['data_source'], pull_mode=cfg['pull_mode'])
+    recorder.stop()
+
+    # A failed pushdown check fails the run, so it can gate later steps
+    if not pushdown_ok:
+        sys.exit(1)
 
 
 def get_wrds_login():
@@ -42,36 +96,107 @@ def get_wrds_login():
             'Please provide a wrds password (it will not show as you type): ')
         return {'wrds_username': wrds_username, 'wrds_password': wrds_password}
 
-def pull_wrds_data(cfg, wrds_authentication):
+def pull_wrds_data(cfg, source):
     '''
-    Pulls WRDS access data.
+    Pulls WRDS access data from the open data source.
     '''
-    db = wrds.Connection(
-        wrds_username=wrds_authentication['wrds_username'], wrds_password=wrds_authentication['wrds_password']
-    )
-
-    log.info('Logged on to WRDS ...')
+    if cfg['filter_location'] == 'sql':
+        log.info("Pulling filtered Worldscope data ... ")
+        wrds_data = source.raw_sql(build_pull_query(cfg))
+        log.info("Pulling filtered Worldscope data ... Done!")
+        return wrds_data
 
     dyn_var_str = ', '.join(cfg['dyn_vars'])
     stat_var_str = ', '.join(cfg['stat_vars'])
 
     log.info("Pulling dynamic Worldscope data ... ")
-    wrds_data_dynamic = db.raw_sql(
-        f"SELECT {dyn_var_str} FROM tr_worldscope.wrds_ws_funda WHERE {cfg['cs_filter']}"
+    wrds_data_dynamic = source.raw_sql(
+        f"SELECT {dyn_var_str} FROM tr_worldscope.wrds_ws_funda WHERE {cfg['cs_filter']} "
+        f"ORDER BY item6105, year_, item5350"
     )
     log.info("Pulling dynamic Worldscope data ... Done!")
 
     log.info("Pulling static Worldscope data ... ")
-    wrds_data_static = db.raw_sql(f"SELECT {stat_var_str} FROM tr_worldscope.wrds_ws_company")
+    wrds_data_static = source.raw_sql(f"SELECT {stat_var_str} FROM tr_worldscope.wrds_ws_company")
     log.info("Pulling static Worldscope data ... Done!")
 
-    db.close()
-    log.info("Disconnected from WRDS")
-
     # Display the number of rows with empty item6105 before filtering
     log.info(f"Rows with empty item6105 in dynamic data before filtering: {wrds_data_dynamic['item6105'].isna().sum()}")
     log.info(f"Rows with empty item6105 in static data before filtering: {wrds_data_static['item6105'].isna().sum()}")
 
+    return merge_and_filter(wrds_data_dynamic, wrds_data_static, cfg)
+
+def sql_list(values):
+    '''
+    Formats a list of strings as a SQL literal list.
+    '''
+    return ', '.join("'" + str(value).replace("'", "''") + "'" for value in values)
+
+def build_pull_query(cfg, dynamic_filter=None, columns=None):
+    '''
+    Builds one SQL statement that joins and filters the Worldscope data in the database.
+
+    The statement applies the same filters as merge_and_filter: non-empty item6105,
+    companies only (item6100 = 'C'), no financial institutions (SIC 6000-6999) and the
+    included and excluded countries. An optional dynamic_filter is added to the
+    conditions on wrds_ws_funda, and columns of wrds_ws_funda can be selected instead
+    of all pulled variables. Rows are ordered by (item6105, year_, item5350), so
+    duplicate firm-years come in the same order in every pull.
+    '''
+    dyn_var_str = ', '.join(cfg['dyn_vars'])
+    stat_var_str = ', '.join(cfg['stat_vars'])
+    if columns is not None:
+        select_str = ', '.join(f"d.{var}" for var in columns)
+    else:
+        select_str = ', '.join(
+            [f"d.{var}" for var in cfg['dyn_vars']] +
+            [f"c.{var}" for var in cfg['stat_vars'] if var not in cfg['dyn_vars']]
+        )
+    dynamic_conditions = [f"({cfg['cs_filter']})", "item6105 IS NOT NULL"]
+    if dynamic_filter:
+        dynamic_conditions.append(f"({dynamic_filter})")
+    # NOT IN () is not valid SQL, so the clause is left out without excluded countries
+    excluded_filter = (
+        f"AND item6026 NOT IN ({sql_list(cfg['excluded_countries'])}) " if cfg['excluded_countries'] else ""
+    )
+
+    return (
+        f"SELECT {select_str} "
+        f"FROM (SELECT {dyn_var_str} FROM tr_worldscope.wrds_ws_funda "
+        f"WHERE {' AND '.join(dynamic_conditions)}) AS d "
+        f"INNER JOIN (SELECT {stat_var_str} FROM tr_worldscope.wrds_ws_company "
+        f"WHERE item6105 IS NOT NULL "
+        f"AND item6100 = 'C' "
+        f"AND item7021 IS NOT NULL "
+        f"AND (CAST(item7021 AS INTEGER) < 6000 OR CAST(item7021 AS INTEGER) > 6999) "
+        f"AND item6026 IN ({sql_list(cfg['included_countries'])}) "
+        f"{excluded_filter}) AS c "
+        f"ON d.item6105 = c.item6105 "
+        f"ORDER BY d.item6105, d.year_, d.item5350"
+    )
+
+def check_filter_pushdown(cfg, source):
+    '''
+    Pulls the data with the filters in SQL and in pandas and checks that both return the same rows.
+    '''
+    sql_data = pull_wrds_data({**cfg, 'filter_location': 'sql'}, source)
+    pandas_data = pull_wrds_data({**cfg, 'filter_location': 'pandas'}, source)
+
+    def normalize(df):
+        return apply_schema(df.copy()).sort_values(['item6105', 'year_']).reset_index(drop=True)
+
+    try:
+        pd.testing.assert_frame_equal(normalize(sql_data), normalize(pandas_data), check_categorical=False)
+    except AssertionError as e:
+        log.error(f"SQL and pandas filtering return different rows: {e}")
+        return False
+    log.info(f"SQL and pandas filtering return the same {len(sql_data)} rows")
+    return True
+
+def merge_and_filter(wrds_data_dynamic, wrds_data_static, cfg):
+    '''
+    Merges dynamic and static Worldscope data and applies the sample filters.
+    '''
     # Filter out rows with empty item6105 in both dynamic and static datasets, because this unique identifier is crucial 
     # for further data preparation step when we filter on firm/year observations
     wrds_data_dynamic = wrds_data_dynamic.dropna(subset=['item6105'])
@@ -91,8 +216,310 @@ def pull_wrds_data(cfg, wrds_authentication):
     # Apply the filter for specified countries given in the paper
     wrds_data = wrds_data[wrds_data['item6026'].isin(cfg['included_countries']) & ~wrds_data['item6026'].isin(cfg['excluded_countries'])]
 
-
     return wrds_data
 
+def pull_wrds_data_streaming(cfg, source):
+    '''
+    Pulls WRDS data partition by partition and writes every partition to its own file.
+
+    With pull_mode 'year' one query is sent per fiscal year. With pull_mode 'chunk' the
+    dynamic data is streamed through a server-side cursor in chunks of chunk_rows rows,
+    and the partitions are cut at the firm boundary nearest to the end of each chunk.
+    Each partition is merged with the static data and filtered as it arrives, so peak
+    memory is bounded by the partition size and the static company table.
+
+    Completed partitions are recorded in a manifest in the partition directory. An
+    interrupted pull resumes after the last completed partition when it is rerun with
+    the same configuration.
+
+    Returns the list of partition file paths in pull order.
+    '''
+    partition_dir = cfg['partition_dir']
+    os.makedirs(partition_dir, exist_ok=True)
+    manifest = load_manifest(partition_dir, pull_signature(cfg))
+    if manifest['partitions']:
+        log.info(f"Resuming pull after {len(manifest['partitions'])} completed partitions")
+    sql_filters = cfg['filter_location'] == 'sql'
+
+    dyn_var_str = ', '.join(cfg['dyn_vars'])
+    stat_var_str = ', '.join(cfg['stat_vars'])
+
+    # Without SQL filters the static company data is joined in pandas. It has one row per
+    # firm and is kept in memory for all partitions.
+    if not sql_filters:
+        log.info("Pulling static Worldscope data ... ")
+        wrds_data_static = source.raw_sql(f"SELECT {stat_var_str} FROM tr_worldscope.wrds_ws_company")
+        log.info("Pulling static Worldscope data ... Done!")
+
+    if cfg['pull_mode'] == 'year':
+        years = source.raw_sql(
+            f"SELECT DISTINCT year_ FROM tr_worldscope.wrds_ws_funda WHERE {cfg['cs_filter']} ORDER BY year_"
+        )['year_'].astype(int).tolist()
+        for year in years:
+            name = f"year_{year}"
+            if name in manifest['partitions']:
+                continue
+            log.info(f"Pulling dynamic Worldscope data for {year} ... ")
+            if sql_filters:
+                chunk = source.raw_sql(build_pull_query(cfg, f"year_ = {year}"))
+            else:
+                chunk = source.raw_sql(
+                    f"SELECT {dyn_var_str} FROM tr_worldscope.wrds_ws_funda WHERE {cfg['cs_filter']} AND year_ = {year} "
+                    f"ORDER BY item6105, year_, item5350"
+                )
+                chunk = merge_and_filter(chunk, wrds_data_static, cfg)
+            save_partition(chunk, name, partition_dir, manifest)
+    elif cfg['pull_mode'] == 'chunk':
+        # Keyset pagination on item6105 lets a resumed pull continue after the last completed chunk.
+        # (item6105, year_) is not unique, so chunks are cut at firm boundaries: the rows of the
+        # last firm of a chunk are held back and saved with the next chunk.
+        dynamic_filter = "item6105 IS NOT NULL"
+        if manifest['partitions']:
+            dynamic_filter += f" AND item6105 > {sql_list([manifest['last_key']])}"
+        if sql_filters:
+            query = build_pull_query(cfg, dynamic_filter)
+        else:
+            query = (
+                f"SELECT {dyn_var_str} FROM tr_worldscope.wrds_ws_funda "
+                f"WHERE {cfg['cs_filter']} AND {dynamic_filter} "
+                f"ORDER BY item6105, year_, item5350"
+            )
+
+        def save_chunk(chunk):
+            name = f"chunk_{len(manifest['partitions']):05d}"
+            manifest['last_key'] = chunk['item6105'].iloc[-1]
+            log.info(f"Pulled dynamic Worldscope chunk {name} ({len(chunk)} rows)")
+            if not sql_filters:
+                chunk = merge_and_filter(chunk, wrds_data_static, cfg)
+            save_partition(chunk, name, partition_dir, manifest)
+
+        held_back = None
+        for chunk in source.read_chunks(query, cfg['chunk_rows']):
+            if held_back is not None:
+                chunk = pd.concat([held_back, chunk], ignore_index=True)
+            last_firm = chunk['item6105'] == chunk['item6105'].iloc[-1]
+            held_back = chunk[last_firm]
+            if not last_firm.all():
+                save_chunk(chunk[~last_firm])
+        if held_back is not None and not held_back.empty:
+            save_chunk(held_back)
+    else:
+        raise ValueError(f"Unknown pull_mode '{cfg['pull_mode']}'. Use 'full', 'year', 'chunk' or 'incremental'.")
+
+    return [os.path.join(partition_dir, entry['file']) for entry in manifest['partitions'].values()]
+
+@instrumented
+def pull_wrds_data_incremental(cfg, source):
+    '''
+    Pulls only the firm-years that are new or changed since the last pull and upserts them
+    into the saved data.
+
+    The saved data is a directory (incremental_dir) with one parquet file per firm bucket,
+    and every firm is kept in the bucket given by a hash of its item6105. The watermark of
+    every firm-year is its fiscal period end date item5350. The keys (item6105, year_,
+    item5350) of the source are compared with the watermarks of the last pull, and a firm
+    is touched if one of its firm-years is new, has a new item5350 or was removed. Only the
+    touched firms are pulled again, in batches of incremental_batch_firms and in the order
+    of the full pull, and only the buckets that hold them are rewritten. Without saved data
+    or watermarks of the same configuration, everything is pulled once.
+
+    The key scan and the watermark file still cover all firm-years. They hold only the
+    three key columns, and with filter_location 'sql' only the firm-years that pass the
+    sample filters. Revisions that keep item5350 and changes of the company data that
+    keep a firm in the sample are only picked up by a full pull.
+    '''
+    store_dir = cfg['incremental_dir']
+    n_buckets = cfg['incremental_buckets']
+    signature = pull_signature(cfg, INCREMENTAL_SIGNATURE_KEYS + ['incremental_buckets'])
+
+    log.info("Pulling firm-year watermarks ... ")
+    if cfg['filter_location'] == 'sql':
+        keys_query = build_pull_query(cfg, columns=WATERMARK_COLUMNS)
+    else:
+        keys_query = (
+            f"SELECT {', '.join(WATERMARK_COLUMNS)} FROM tr_worldscope.wrds_ws_funda "
+            f"WHERE {cfg['cs_filter']} AND item6105 IS NOT NULL"
+        )
+    keys = apply_schema(source.raw_sql(keys_query)).drop_duplicates()
+    log.info(f"Pulling firm-year watermarks ... Done! {len(keys)} firm-years")
+
+    watermarks = load_watermarks(cfg['watermark_path'], signature)
+    if watermarks is None or not os.path.isdir(store_dir):
+        log.info("No watermarks of a previous pull with this configuration. Pulling all firm-years.")
+        wrds_data = apply_schema(pull_wrds_data(cfg, source))
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.makedirs(store_dir)
+        for bucket, bucket_data in wrds_data.groupby(firm_buckets(wrds_data['item6105'], n_buckets)):
+            write_bucket(bucket_data, store_dir, bucket)
+        log.info(f"Saved {len(wrds_data)} firm-years in {n_buckets} firm buckets to {store_dir}")
+        save_watermarks(keys, cfg['watermark_path'], signature)
+        return
+
+    # Firm-years whose watermark is new, changed or gone since the last pull
+    changes = keys.merge(watermarks, on=WATERMARK_COLUMNS, how='outer', indicator=True)
+    changes = changes[changes['_merge'] != 'both']
+    touched = sorted(changes['item6105'].unique())
+    sides = changes.assign(
+        in_source=changes['_merge'] == 'left_only', in_watermarks=changes['_merge'] == 'right_only'
+    ).groupby(['item6105', 'year_'])[['in_source', 'in_watermarks']].any()
+    counts = {
+        'new': int((sides['in_source'] & ~sides['in_watermarks']).sum()),
+        'changed': int((sides['in_source'] & sides['in_watermarks']).sum()),
+        'removed': int((~sides['in_source'] & sides['in_watermarks']).sum()),
+    }
+    log.info(
+        f"{counts['new']} new, {counts['changed']} changed and {counts['removed']} removed firm-years "
+        f"in {len(touched)} firms"
+    )
+    record(touched_firms=len(touched), **{f"{kind}_firm_years": count for kind, count in counts.items()})
+    if not touched:
+        log.info(f"{store_dir} is up to date")
+        return
+
+    # Pull all firm-years of the touched firms and join only their static company data
+    dyn_var_str = ', '.join(cfg['dyn_vars'])
+    stat_var_str = ', '.join(cfg['stat_vars'])
+    batch_size = cfg['incremental_batch_firms']
+    batches = []
+    for start in range(0, len(touched), batch_size):
+        firm_filter = f"item6105 IN ({sql_list(touched[start:start + batch_size])})"
+        log.info(f"Pulling touched firms {start + 1} to {min(start + batch_size, len(touched))} ... ")
+        if cfg['filter_location'] == 'sql':
+            batch = source.raw_sql(build_pull_query(cfg, firm_filter))
+        else:
+            wrds_data_dynamic = source.raw_sql(
+                f"SELECT {dyn_var_str} FROM tr_worldscope.wrds_ws_funda WHERE {cfg['cs_filter']} AND {firm_filter} "
+                f"ORDER BY item6105, year_, item5350"
+            )
+            wrds_data_static = source.raw_sql(
+                f"SELECT {stat_var_str} FROM tr_worldscope.wrds_ws_company WHERE {firm_filter}"
+            )
+            batch = merge_and_filter(wrds_data_dynamic, wrds_data_static, cfg)
+        batches.append(apply_schema(batch))
+    delta = pd.concat(batches, ignore_index=True)
+
+    # Upsert: in the buckets of the touched firms, these firms are replaced and firms that no
+    # longer pass the filters are removed. The other buckets are not read or written.
+    delta_buckets = firm_buckets(delta['item6105'], n_buckets)
+    touched_buckets = np.unique(firm_buckets(pd.Series(touched), n_buckets))
+    for bucket in touched_buckets:
+        path = os.path.join(store_dir, bucket_file(bucket))
+        parts = [delta[delta_buckets == bucket]]
+        if os.path.exists(path):
+            saved = read_table(path)
+            parts.insert(0, saved[~saved['item6105'].isin(touched)])
+        # The stable sort keeps the pulled order of duplicate firm-years
+        bucket_data = pd.concat(parts, ignore_index=True).sort_values(['item6105', 'year_'], kind='stable')
+        write_bucket(bucket_data, store_dir, bucket)
+    log.info(
+        f"Upserted {len(delta)} firm-years of {len(touched)} touched firms, "
+        f"rewrote {len(touched_buckets)} of {n_buckets} firm buckets"
+    )
+    record(rewritten_buckets=len(touched_buckets))
+    save_watermarks(keys, cfg['watermark_path'], signature)
+
+def firm_buckets(firms, n_buckets):
+    '''
+    Returns the bucket of every firm, from a CRC32 hash of its item6105 that is the same in every run.
+    '''
+    codes, uniques = pd.factorize(firms)
+    buckets = np.array([zlib.crc32(str(firm).encode('utf-8')) % n_buckets for firm in uniques], dtype=np.int64)
+    return buckets[codes]
+
+def bucket_file(bucket):
+    '''
+    Returns the file name of a firm bucket of the incremental pull.
+    '''
+    return f"bucket_{bucket:04d}.parquet"
+
+def write_bucket(bucket_data, store_dir, bucket):
+    '''
+    Writes the firm-years of one firm bucket, or removes the bucket file if no firm-years are left.
+    The file is written under a name starting with '_' first, which readers of the directory
+    skip, and then renamed.
+    '''
+    path = os.path.join(store_dir, bucket_file(bucket))
+    if bucket_data.empty:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp_path = os.path.join(store_dir, '_' + bucket_file(bucket))
+    write_table(bucket_data, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_watermarks(path, signature):
+    '''
+    Loads the firm-year watermarks of the last incremental pull, or None if they are
+    missing or belong to another configuration.
+    '''
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(path):
+        return None
+    table = pq.read_table(path)
+    if (table.schema.metadata or {}).get(b'pull_signature', b'').decode() != signature:
+        log.warning("Pull configuration changed since the last incremental pull.")
+        return None
+    return apply_schema(table.to_pandas())
+
+def save_watermarks(keys, path, signature):
+    '''
+    Saves the firm-year watermarks with the signature of the pull configuration.
+    The file is written under a temporary name first and then renamed.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(keys, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'pull_signature': signature.encode('utf-8')})
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    log.info(f"Saved {len(keys)} firm-year watermarks to {path}")
+
+def pull_signature(cfg, keys=PARTITION_SIGNATURE_KEYS):
+    '''
+    Hashes the configuration entries that determine the content of the pulled data.
+    '''
+    payload = json.dumps({key: cfg[key] for key in keys}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def load_manifest(partition_dir, signature):
+    '''
+    Loads the pull manifest, or starts a new one if it is missing or belongs to another configuration.
+    '''
+    manifest_path = os.path.join(partition_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['signature'] != signature:
+            log.warning("Pull configuration changed since the last run. Starting a new pull.")
+        elif isinstance(manifest['last_key'], list):
+            # Older manifests kept a (item6105, year_) key that can split duplicate firm-years
+            log.warning("Manifest of a pull with chunks cut inside firms. Starting a new pull.")
+        else:
+            return manifest
+    return {'signature': signature, 'partitions': {}, 'last_key': None}
+
+def save_partition(wrds_data, name, partition_dir, manifest):
+    '''
+    Writes one partition and records it in the manifest.
+
+    Both files are written under a temporary name first and then renamed, so an
+    interruption never leaves a half-written partition marked as completed.
+    '''
+    file_name = f"{name}.parquet"
+    tmp_path = os.path.join(partition_dir, f"{name}.tmp.parquet")
+    write_table(wrds_data, tmp_path)
+    os.replace(tmp_path, os.path.join(partition_dir, file_name))
+
+    manifest['partitions'][name] = {'file': file_name, 'rows': len(wrds_data)}
+    manifest_path = os.path.join(partition_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    log.info(f"Saved partition {name} with {len(wrds_data)} rows")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,189 @@
+# --- Header -------------------------------------------------------------------
+# Firm-year EM results store with lookups by firm, country and year
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from utils import setup_logging
+
+log = setup_logging()
+
+# Identifiers of a firm-year, every query returns them
+KEY_COLUMNS = ['item6105', 'item6026', 'year_']
+
+# Order of the rows returned by the queries
+SORT_COLUMNS = ['item6026', 'item6105', 'year_']
+
+# Partition directories of the store, one per country and year
+PARTITIONING = ds.partitioning(pa.schema([('item6026', pa.string()), ('year_', pa.int32())]), flavor='hive')
+
+# Firm index next to the partitions. Files starting with '_' are not part of the dataset.
+FIRM_INDEX_FILE = '_firm_index.parquet'
+
+
+def write_results_store(results, path, key=None, row_group_rows=10000):
+    '''
+    Writes the firm-year results to the store at path, replacing an existing store.
+
+    The firm-years are written to one directory per country and year (item6026=.../year_=...)
+    and sorted by firm within each file, in row groups of at most row_group_rows rows, so the
+    row group statistics of item6105 narrow down firm lookups within a file. The firm index
+    holds the country and the first and last year of every firm, and the key of the store in
+    its metadata. The store is written next to the old one and then swapped in.
+    '''
+    tmp_path = start_results_store(path)
+    results = results.astype({'item6105': str, 'item6026': str}).sort_values(['item6026', 'year_', 'item6105'])
+    table = pa.Table.from_pandas(results.reset_index(drop=True), preserve_index=False)
+    table = table.cast(table.schema.set(table.schema.get_field_index('year_'), pa.field('year_', pa.int32())))
+    ds.write_dataset(
+        table, tmp_path, format='parquet', partitioning=PARTITIONING,
+        max_rows_per_group=row_group_rows, min_rows_per_group=0,
+    )
+
+    firm_index = results.groupby('item6105', sort=True).agg(
+        item6026=('item6026', 'first'), first_year=('year_', 'min'), last_year=('year_', 'max')
+    ).reset_index()
+    finish_results_store(firm_index, tmp_path, path, key)
+    log.info(f"Results store with {len(results)} firm-years of {len(firm_index)} firms saved to {path}")
+
+
+def start_results_store(path):
+    '''
+    Returns the path next to the store at path that a new store is written to and removes
+    what an interrupted write left there.
+    '''
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    return tmp_path
+
+
+def finish_results_store(firm_index, tmp_path, path, key=None):
+    '''
+    Writes the firm index with the key of the store to the new store at tmp_path and swaps
+    it in for the store at path. The firm index has the columns item6105, item6026,
+    first_year and last_year and is sorted by item6105.
+    '''
+    index_table = pa.Table.from_pandas(firm_index, preserve_index=False)
+    if key is not None:
+        index_table = index_table.replace_schema_metadata({**index_table.schema.metadata, b'store_key': key.encode()})
+    pq.write_table(index_table, os.path.join(tmp_path, FIRM_INDEX_FILE))
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def read_store_key(path):
+    '''
+    Returns the key of the store at path, or None if there is no store.
+    '''
+    index_path = os.path.join(path, FIRM_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+    metadata = pq.read_schema(index_path).metadata or {}
+    key = metadata.get(b'store_key')
+    return key.decode() if key is not None else None
+
+
+class FirmYearStore:
+    '''
+    Query API of a firm-year results store written by write_results_store.
+
+    Queries only open the partitions that can hold matching rows: countries and year ranges
+    select partition directories, and a firm is looked up in the firm index first, so only
+    the partitions of its country and years are read. Only the requested columns are read.
+    The values are returned as numbers, as they were calculated, and the rows are sorted
+    by country, firm and year.
+    '''
+
+    def __init__(self, path):
+        if not os.path.exists(os.path.join(path, FIRM_INDEX_FILE)):
+            raise FileNotFoundError(f"Results store {path} not found. Create it with code/python/do_analysis.py")
+        self.path = path
+        self.dataset = ds.dataset(path, format='parquet', partitioning=PARTITIONING)
+        self._firm_index = None
+
+    def firm_index(self):
+        '''
+        Returns the country and the first and last year of every firm, indexed by item6105.
+        '''
+        if self._firm_index is None:
+            self._firm_index = pd.read_parquet(os.path.join(self.path, FIRM_INDEX_FILE)).set_index('item6105')
+        return self._firm_index
+
+    def firm(self, item6105, columns=None):
+        '''
+        Returns the firm-years of one firm (an empty table if the firm is not in the store).
+        '''
+        firm_index = self.firm_index()
+        if item6105 not in firm_index.index:
+            return self.dataset.schema.empty_table().select(self.columns(columns)).to_pandas()
+        firm = firm_index.loc[item6105]
+        return self.query(
+            item6105=item6105, item6026=firm['item6026'], first_year=firm['first_year'],
+            last_year=firm['last_year'], columns=columns
+        )
+
+    def country(self, item6026, first_year=None, last_year=None, columns=None):
+        '''
+        Returns the firm-years of one or more countries, optionally within a range of years.
+        '''
+        return self.query(item6026=item6026, first_year=first_year, last_year=last_year, columns=columns)
+
+    def years(self, first_year=None, last_year=None, columns=None):
+        '''
+        Returns the firm-years of all countries from first_year to last_year.
+        '''
+        return self.query(first_year=first_year, last_year=last_year, columns=columns)
+
+    def query(self, item6105=None, item6026=None, first_year=None, last_year=None, columns=None):
+        '''
+        Returns the firm-years that meet all given conditions.
+
+        item6105 and item6026 can be a single value or a list of values, and first_year and
+        last_year bound the years (inclusive). Without columns all columns are returned.
+        '''
+        conditions = []
+        if item6026 is not None:
+            conditions.append(matches('item6026', item6026))
+        if first_year is not None:
+            conditions.append(ds.field('year_') >= int(first_year))
+        if last_year is not None:
+            conditions.append(ds.field('year_') <= int(last_year))
+        if item6105 is not None:
+            conditions.append(matches('item6105', item6105))
+        condition = None
+        for expression in conditions:
+            condition = expression if condition is None else condition & expression
+
+        df = self.dataset.to_table(columns=self.columns(columns), filter=condition).to_pandas()
+        return df.sort_values(SORT_COLUMNS).reset_index(drop=True)
+
+    def columns(self, columns=None):
+        '''
+        Returns the identifiers and the requested columns (all columns if None).
+        '''
+        if columns is None:
+            return self.dataset.schema.names
+        return KEY_COLUMNS + [column for column in columns if column not in KEY_COLUMNS]
+
+
+def matches(column, values):
+    '''
+    Returns the filter expression for a column that equals a single value or one of a list of values.
+
+    A single value is compared with ==, which the row group statistics can skip row groups
+    for, unlike isin.
+    '''
+    if isinstance(values, (list, tuple, set, pd.Index, pd.Series)):
+        values = list(values)
+        return ds.field(column) == values[0] if len(values) == 1 else ds.field(column).isin(values)
+    return ds.field(column) == values
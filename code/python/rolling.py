@@ -0,0 +1,338 @@
+# --- Header -------------------------------------------------------------------
+# Country EM measures and ranks over rolling windows of fiscal years
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import pickle
+
+import numpy as np
+import pandas as pd
+from bootstrap import sorted_ties, weighted_spearman
+from do_analysis import accruals_and_cfo, calculate_aggregate, em2_values, em3_values, em4_flags, load_data
+from panel import FirmPanel
+from sweep import add_ranks
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+
+def main():
+    '''
+    Calculates EM1-EM4, the ranks and the aggregate score for every rolling window of years.
+
+    The firm-year components are computed once from the prepared data. The window then
+    slides one year at a time and only the firm-years that enter or leave it update the
+    firm standard deviations, the country medians and the small profit and loss counts.
+    The results are saved as one tidy table with one row per window and country.
+    '''
+    log.info("Running rolling windows ...")
+    cfg = read_config('config/rolling_cfg.yaml')
+    analysis_cfg = read_config('config/do_analysis_cfg.yaml')
+
+    components = rolling_components(load_data(analysis_cfg['prepared_data_save_path']), analysis_cfg['em4_profit_band'])
+    results = run_rolling(
+        components, cfg['window_years'], cfg['first_year'], cfg['last_year'],
+        analysis_cfg['em4_min_small_losses']
+    )
+
+    with open(cfg['rolling_results'], 'wb') as f:
+        pickle.dump({'rolling_results': results}, f)
+    log.info(f"Rolling results saved to {cfg['rolling_results']}")
+    log.info("Running rolling windows ... Done!")
+
+
+def rolling_components(df, profit_band=0.01):
+    '''
+    Computes the firm-year components of EM1-EM4 once for the whole panel.
+
+    Returns the firm-years sorted by firm and year with the firm position, operating income,
+    CFO, lagged total assets, the firm-year EM3 and EM2 inputs and the small profit and loss
+    flags. Lags and changes come from the previous year of the firm, also in the first year
+    of a window, so the components are the same in every window that contains the firm-year.
+    '''
+    panel = FirmPanel(df)
+    accruals, cfo = accruals_and_cfo(panel)
+
+    data = panel.data[['item6105', 'year_', 'item6026', 'item1651']].copy()
+    data['Accruals'] = accruals
+    data['CFO'] = cfo
+    data['lagged_total_assets'] = panel.lag(panel.values('item2999'))
+    data['delta_Accruals'] = panel.diff(accruals)
+    data['delta_CFO'] = panel.diff(cfo)
+
+    scaled_delta_accruals, scaled_delta_cfo = em2_values(data)
+    small_profits, small_losses = em4_flags(data, profit_band)
+    return pd.DataFrame({
+        'firm': panel.firm_index,
+        'year_': data['year_'],
+        'item6026': data['item6026'],
+        'operating_income': panel.values('item1250'),
+        'CFO': cfo,
+        'lagged_total_assets': data['lagged_total_assets'],
+        'EM3': em3_values(data),
+        'scaled_delta_Accruals': scaled_delta_accruals,
+        'scaled_delta_CFO': scaled_delta_cfo,
+        'small_profits': small_profits,
+        'small_losses': small_losses,
+    })
+
+
+def run_rolling(components, window_years, first_year=None, last_year=None, min_small_losses=5):
+    '''
+    Slides a window of window_years fiscal years from first_year to last_year and collects
+    the aggregate table with the ranks of every window in one tidy table.
+
+    Without first_year or last_year the windows cover all years of the components.
+    '''
+    first_year = int(components['year_'].min()) if first_year is None else first_year
+    last_year = int(components['year_'].max()) if last_year is None else last_year
+    if last_year - first_year + 1 < window_years:
+        raise ValueError(f"The years {first_year}-{last_year} do not fill a window of {window_years} years")
+
+    window = RollingWindow(components, min_small_losses)
+    years = components['year_'].to_numpy()
+    results = []
+    for year in range(first_year, last_year + 1):
+        leaving_year = year - window_years
+        window.advance(
+            np.flatnonzero(years == year),
+            np.flatnonzero(years == leaving_year) if leaving_year >= first_year else np.zeros(0, dtype=np.int64)
+        )
+        if year - first_year + 1 < window_years:
+            continue
+        final_table = add_ranks(calculate_aggregate(*window.country_tables()))
+        log.info(f"Window {leaving_year + 1}-{year}: {len(final_table)} countries")
+        settings = pd.DataFrame({'first_year': [leaving_year + 1] * len(final_table), 'last_year': year})
+        results.append(pd.concat([settings, final_table], axis=1))
+    return pd.concat(results, ignore_index=True)
+
+
+class RollingWindow:
+    '''
+    EM1-EM4 of the firm-years in a window that is updated one year at a time.
+
+    The state is kept so that a firm-year entering or leaving the window only updates what
+    it contributes to:
+
+    - the firm standard deviations of operating income and CFO come from running counts,
+      sums and sums of squares per firm. The values are taken relative to the firm mean
+      over the whole panel, so the sums of squares do not lose precision for firms with
+      large values. They equal the standard deviations of build_em_panel up to rounding.
+    - EM1 of a firm changes with its standard deviations, so it is updated for all window
+      firm-years of the firms with an entering or leaving firm-year. These are most firms
+      of a window, so the country medians are selected from the updated values instead of
+      kept sorted.
+    - the country medians of EM3 come from per-country arrays of the firm-year values in
+      the window, which are kept sorted. The firm-years of the year that leaves are
+      removed and those of the year that enters are inserted.
+    - EM2 is a rank correlation over all firm-years of the window. The firm-year pairs of
+      every country are sorted once and the window ranks are counted along this order
+      with weighted_spearman from the bootstrap, weighting the firm-years in the window
+      by one and all others by zero.
+    - EM4 comes from running counts of small profits and small losses per country.
+    '''
+
+    def __init__(self, components, min_small_losses=5):
+        self.components = components
+        self.min_small_losses = min_small_losses
+        self.firm = components['firm'].to_numpy()
+        n_firms = int(self.firm.max()) + 1 if len(self.firm) else 0
+        firm_start = np.ones(len(self.firm), dtype=bool)
+        firm_start[1:] = self.firm[1:] != self.firm[:-1]
+        self.firm_starts = np.flatnonzero(firm_start)
+        self.firm_stops = np.append(self.firm_starts[1:], len(self.firm))
+        self.country, self.countries = pd.factorize(components['item6026'], sort=True)
+        n_countries = len(self.countries)
+        self.country_positions = np.split(
+            np.argsort(self.country, kind='stable'), np.cumsum(np.bincount(self.country, minlength=n_countries))[:-1]
+        )
+
+        self.lagged_total_assets = components['lagged_total_assets'].to_numpy(dtype=np.float64)
+        self.em3 = components['EM3'].to_numpy(dtype=np.float64)
+        self.small_profits = components['small_profits'].to_numpy(dtype=np.int64)
+        self.small_losses = components['small_losses'].to_numpy(dtype=np.int64)
+
+        # Firm-year pairs of each country with their sort order and tie groups, as in build_contributions
+        x = components['scaled_delta_Accruals'].to_numpy(dtype=np.float64)
+        y = components['scaled_delta_CFO'].to_numpy(dtype=np.float64)
+        finite = np.isfinite(x) & np.isfinite(y)
+        self.em2_pairs = []
+        for positions in self.country_positions:
+            rows = positions[finite[positions]]
+            self.em2_pairs.append((rows, (np.arange(len(rows)), sorted_ties(x[rows]), sorted_ties(y[rows]))))
+
+        # Firm values relative to the firm mean, with running count, sum and sum of squares per firm
+        self.deviations = {}
+        self.moments = {}
+        for column in ['operating_income', 'CFO']:
+            values = components[column].to_numpy(dtype=np.float64)
+            valid = ~np.isnan(values)
+            counts = np.bincount(self.firm[valid], minlength=n_firms)
+            sums = np.bincount(self.firm[valid], weights=values[valid], minlength=n_firms)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.deviations[column] = values - (sums / counts)[self.firm]
+            self.moments[column] = np.zeros((3, n_firms))
+
+        self.in_window = np.zeros(len(self.firm), dtype=bool)
+        self.em1 = np.full(len(self.firm), np.nan)
+        self.sorted_em3 = [np.zeros(0) for _ in range(n_countries)]
+        self.country_rows = np.zeros(n_countries, dtype=np.int64)
+        self.country_small_profits = np.zeros(n_countries, dtype=np.int64)
+        self.country_small_losses = np.zeros(n_countries, dtype=np.int64)
+
+    def advance(self, entering, leaving):
+        '''
+        Adds the firm-years at the entering positions to the window and removes those at the leaving positions.
+        '''
+        firms = np.unique(self.firm[np.concatenate([entering, leaving])])
+        firm_rows = concatenate_ranges(self.firm_starts[firms], self.firm_stops[firms])
+
+        self.em1[firm_rows] = np.nan
+        self.in_window[leaving] = False
+        self.in_window[entering] = True
+        for column, moments in self.moments.items():
+            for rows, sign in [(leaving, -1), (entering, 1)]:
+                deviations = self.deviations[column][rows]
+                valid = ~np.isnan(deviations)
+                for power in range(3):
+                    moments[power] += sign * np.bincount(
+                        self.firm[rows][valid], weights=deviations[valid] ** power, minlength=moments.shape[1]
+                    )
+
+        # EM1 of the changed firms with their standard deviations in the updated window
+        new_rows = firm_rows[self.in_window[firm_rows]]
+        std = {column: self.firm_std(column, firms) for column in self.moments}
+        row_firms = np.searchsorted(firms, self.firm[new_rows])
+        lagged_total_assets = self.lagged_total_assets[new_rows]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.em1[new_rows] = (
+                (std['operating_income'][row_firms] / lagged_total_assets)
+                / (std['CFO'][row_firms] / lagged_total_assets)
+            )
+
+        self.update_sorted(self.sorted_em3, leaving, self.em3, remove=True)
+        self.update_sorted(self.sorted_em3, entering, self.em3, remove=False)
+
+        for rows, sign in [(leaving, -1), (entering, 1)]:
+            country = self.country[rows]
+            n_countries = len(self.countries)
+            self.country_rows += sign * np.bincount(country, minlength=n_countries)
+            self.country_small_profits += sign * np.bincount(
+                country, weights=self.small_profits[rows], minlength=n_countries
+            ).astype(np.int64)
+            self.country_small_losses += sign * np.bincount(
+                country, weights=self.small_losses[rows], minlength=n_countries
+            ).astype(np.int64)
+
+    def firm_std(self, column, firms):
+        '''
+        Returns the sample standard deviation (ddof=1) in the window of the given firms, NaN below two values.
+        '''
+        counts, sums, squares = self.moments[column][:, firms]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.maximum(squares - sums ** 2 / counts, 0) / (counts - 1)
+        std = np.sqrt(variance)
+        std[counts < 2] = np.nan
+        return std
+
+    def update_sorted(self, sorted_values, rows, values, remove):
+        '''
+        Removes or inserts the non-missing values of the rows in the sorted arrays of their countries.
+        '''
+        rows = rows[~np.isnan(values[rows])]
+        rows = rows[np.argsort(self.country[rows], kind='stable')]
+        codes, starts = np.unique(self.country[rows], return_index=True)
+        for code, country_values in zip(codes, np.split(values[rows], starts[1:])):
+            if remove:
+                sorted_values[code] = remove_sorted(sorted_values[code], country_values)
+            else:
+                sorted_values[code] = insert_sorted(sorted_values[code], country_values)
+
+    def em1_median(self, code):
+        '''
+        Returns the median EM1 of the window firm-years of a country (NaN if there are none).
+        '''
+        values = self.em1[self.country_positions[code]]
+        values = values[~np.isnan(values)]
+        return np.median(values) if len(values) else np.nan
+
+    def country_tables(self):
+        '''
+        Returns the country tables of EM1, EM2, EM3 and EM4 of the window, as calculate_em1 to calculate_em4.
+        '''
+        present = np.flatnonzero(self.country_rows > 0)
+        countries = self.countries[present]
+        country_em1 = pd.DataFrame({
+            'item6026': countries,
+            'EM1': [self.em1_median(code) for code in present],
+        })
+        country_em3 = pd.DataFrame({
+            'item6026': countries,
+            'EM3': [sorted_median(self.sorted_em3[code]) for code in present],
+        })
+
+        country_em2 = pd.DataFrame({
+            'item6026': countries,
+            'EM2': [
+                weighted_spearman(self.em2_pairs[code][1], self.in_window[self.em2_pairs[code][0]][None, :])[0]
+                for code in present
+            ],
+        })
+
+        eligible = present[self.country_small_losses[present] >= self.min_small_losses]
+        country_em4 = pd.DataFrame({
+            'item6026': self.countries[eligible],
+            'EM4': self.country_small_profits[eligible] / np.maximum(1, self.country_small_losses[eligible]),
+        })
+
+        tables = [country_em1, country_em2, country_em3, country_em4]
+        for table, metric in zip(tables, ['EM1', 'EM2', 'EM3', 'EM4']):
+            table['item6026'] = table['item6026'].astype(object)
+            table[metric] = table[metric].round(3)
+        return tables
+
+
+def concatenate_ranges(starts, stops):
+    '''
+    Returns the positions of the ranges [start, stop) one after the other.
+    '''
+    lengths = stops - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def remove_sorted(sorted_values, values):
+    '''
+    Removes one occurrence of each value from a sorted array.
+    '''
+    values = np.sort(values)
+    positions = np.searchsorted(sorted_values, values, side='left')
+    # Repeated values remove the following occurrences of the value
+    run_start = np.ones(len(values), dtype=bool)
+    run_start[1:] = values[1:] != values[:-1]
+    runs = np.flatnonzero(run_start)
+    positions += np.arange(len(values)) - np.repeat(runs, np.diff(np.append(runs, len(values))))
+    return np.delete(sorted_values, positions)
+
+
+def insert_sorted(sorted_values, values):
+    '''
+    Inserts values into a sorted array, keeping it sorted.
+    '''
+    values = np.sort(values)
+    return np.insert(sorted_values, np.searchsorted(sorted_values, values), values)
+
+
+def sorted_median(sorted_values):
+    '''
+    Returns the median of a sorted array (NaN if it is empty).
+    '''
+    n = len(sorted_values)
+    if n == 0:
+        return np.nan
+    return (sorted_values[(n - 1) // 2] + sorted_values[n // 2]) / 2
+
+
+if __name__ == "__main__":
+    main()
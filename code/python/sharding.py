@@ -0,0 +1,127 @@
+# --- Header -------------------------------------------------------------------
+# Process-pool execution of per-group stages on shards of a panel in shared memory
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from instrument import recorder
+from utils import setup_logging
+
+log = setup_logging()
+
+# Panel rebuilt from shared memory once per worker process by the pool initializer
+_worker_panel = None
+_worker_shared_memory = []
+
+
+def share_panel(panel):
+    '''
+    Copies the panel columns into shared memory blocks.
+
+    Categorical columns are shared as integer codes. Returns the shared memory blocks and
+    the layout that the workers need to rebuild the panel without copying it through pickle.
+    '''
+    blocks = []
+    layout = []
+    for column in panel.columns:
+        series = panel[column]
+        categories = None
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = series.cat.categories
+            values = series.cat.codes.to_numpy()
+        elif pd.api.types.is_string_dtype(series.dtype) or series.dtype == object:
+            series = series.astype('category')
+            categories = series.cat.categories
+            values = series.cat.codes.to_numpy()
+        else:
+            values = series.to_numpy()
+        block = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        blocks.append(block)
+        layout.append((column, block.name, values.dtype.str, values.shape, categories))
+    return blocks, layout
+
+
+def attach_panel(layout):
+    '''
+    Rebuilds the panel from the shared memory blocks described by the layout.
+    '''
+    blocks = []
+    columns = {}
+    for column, name, dtype, shape, categories in layout:
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        values = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        if categories is not None:
+            columns[column] = pd.Categorical.from_codes(values, categories=categories)
+        else:
+            columns[column] = values
+    return pd.DataFrame(columns, copy=False), blocks
+
+
+def release_panel(blocks):
+    '''
+    Closes and removes the shared memory blocks of a panel.
+    '''
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def group_shards(panel, column):
+    '''
+    Sorts the panel by the group column and returns it with one (group, start, stop) row
+    range per group.
+
+    The sort is stable, so the rows of every group keep their order from the panel. Rows
+    without a group are left out, as in a groupby.
+    '''
+    panel = panel[panel[column].notna()].sort_values(column, kind='stable').reset_index(drop=True)
+    sizes = panel.groupby(column, observed=True, sort=False).size()
+    stops = np.cumsum(sizes.to_numpy())
+    starts = stops - sizes.to_numpy()
+    return panel, list(zip(sizes.index, starts, stops))
+
+
+def _init_worker(layout):
+    global _worker_panel, _worker_shared_memory
+    _worker_panel, _worker_shared_memory = attach_panel(layout)
+    # The stages log and record per shard, only the gathered results are reported by the parent
+    log.setLevel(logging.WARNING)
+    recorder.stop()
+
+
+def _run_worker_shard(function, start, stop, args):
+    return function(_worker_panel.iloc[start:stop], *args)
+
+
+def run_sharded(panel, column, function, workers=1, args=()):
+    '''
+    Runs function(shard, *args) for the rows of every group of the panel column.
+
+    The panel is sorted by the group column and copied into shared memory once. Every
+    worker process rebuilds it from the shared blocks and slices out the shards it is
+    given, so only the row ranges are pickled. The largest shards are submitted first,
+    which keeps the workers busy when a few groups hold most of the rows. The function
+    must be defined at module level.
+
+    Returns a dict of the results by group, in the sort order of the groups.
+    '''
+    panel, shards = group_shards(panel, column)
+    shards_by_size = sorted(shards, key=lambda shard: shard[2] - shard[1], reverse=True)
+    blocks, layout = share_panel(panel)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(layout,)) as pool:
+            futures = {
+                group: pool.submit(_run_worker_shard, function, start, stop, args)
+                for group, start, stop in shards_by_size
+            }
+            return {group: futures[group].result() for group, _, _ in shards}
+    finally:
+        release_panel(blocks)
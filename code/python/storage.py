@@ -0,0 +1,148 @@
+# --- Header -------------------------------------------------------------------
+# Typed columnar storage for the hand-off between pull, prepare and analysis
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import os
+import pandas as pd
+
+# Explicit schema for the Worldscope columns used in this project. Numeric
+# accounting items are stored as floats, identifiers as strings, the entity type
+# and country code as categoricals, and the fiscal year as an integer.
+ITEM_SCHEMA = {
+    'item6105': 'string',          # Worldscope Permanent ID
+    'year_': 'int16',              # Year
+    'item5350': 'datetime64[ns]',  # Fiscal Period End Date
+    'item2003': 'float64',         # Cash
+    'item3051': 'float64',         # Short Term Debt and Current Portion of Long Term Debt
+    'item3063': 'float64',         # Income Taxes Payable
+    'item1151': 'float64',         # Depreciation, depletion, and amortization
+    'item2999': 'float64',         # Total Assets
+    'item1001': 'float64',         # Net Sales or Revenues
+    'item1250': 'float64',         # Operating Income
+    'item1651': 'float64',         # Net Income before preferred dividends
+    'item3101': 'float64',         # Current Liabilities - Total
+    'item2201': 'float64',         # Current Assets - Total
+    'item6001': 'string',          # Company Name
+    'item6100': 'category',        # Entity Type
+    'item6026': 'category',        # Country Code
+    'item7021': 'Int32',           # SIC Code
+}
+
+SUPPORTED_FORMATS = ('parquet', 'csv')
+
+
+def storage_format(path):
+    '''
+    Returns the storage format selected by the file extension of the path.
+    A directory is read as a table split into parquet files.
+    '''
+    if os.path.isdir(path):
+        return 'parquet'
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension not in SUPPORTED_FORMATS:
+        raise ValueError(f"Unsupported storage format '{extension}' for {path}. Use one of: {', '.join(SUPPORTED_FORMATS)}")
+    return extension
+
+
+def apply_schema(df, float_dtype='float64'):
+    '''
+    Casts the known item columns of a dataframe to the project schema.
+
+    Columns that are not part of the schema are left untouched. The float dtype
+    of the numeric accounting items can be set to 'float32' to halve their memory.
+    '''
+    dtypes = {}
+    for column, dtype in ITEM_SCHEMA.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'float64':
+            dtype = float_dtype
+        if str(df[column].dtype) != dtype:
+            dtypes[column] = dtype
+
+    for column, dtype in dtypes.items():
+        if dtype.startswith('datetime'):
+            df[column] = pd.to_datetime(df[column])
+        elif dtype == 'Int32':
+            df[column] = pd.to_numeric(df[column]).astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def read_table(path, columns=None, float_dtype='float64'):
+    '''
+    Reads a table from a parquet or csv file, or from a directory of parquet files such as
+    the firm buckets of the incremental pull, and applies the project schema.
+
+    Only the requested columns are read. For parquet files the columns are
+    selected before decoding, so unused columns are never loaded.
+    '''
+    file_format = storage_format(path)
+    if os.path.isdir(path):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        # Every file has its own dictionary of a categorical column, so these columns are
+        # read as plain strings and become categoricals again through the schema
+        dataset = ds.dataset(path, format='parquet')
+        schema = pa.schema([
+            field.with_type(field.type.value_type) if pa.types.is_dictionary(field.type) else field
+            for field in dataset.schema
+        ])
+        df = ds.dataset(path, format='parquet', schema=schema).to_table(columns=columns).to_pandas()
+    elif file_format == 'parquet':
+        df = pd.read_parquet(path, columns=columns)
+    else:
+        csv_dtypes = {
+            column: dtype for column, dtype in ITEM_SCHEMA.items()
+            if dtype in ('string', 'category') and (columns is None or column in columns)
+        }
+        df = pd.read_csv(path, usecols=columns, dtype=csv_dtypes)
+    return apply_schema(df, float_dtype=float_dtype)
+
+
+def write_table(df, path, export_csv=False):
+    '''
+    Writes a table to a parquet or csv file, selected by the file extension.
+
+    If export_csv is set, a csv copy is written next to a parquet file.
+    '''
+    file_format = storage_format(path)
+    df = apply_schema(df.copy(deep=False))
+    for column in df.select_dtypes('category').columns:
+        df[column] = df[column].cat.remove_unused_categories()
+    if file_format == 'parquet':
+        df.to_parquet(path, index=False)
+        if export_csv:
+            df.to_csv(os.path.splitext(path)[0] + '.csv', index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def combine_partitions(partition_paths, path, export_csv=False):
+    '''
+    Combines parquet partition files into one table file, one partition at a time.
+
+    Only one partition is held in memory, so combining is bounded by the size of the
+    largest partition rather than by the size of the full table.
+    '''
+    import pyarrow.parquet as pq
+
+    file_format = storage_format(path)
+    csv_path = path if file_format == 'csv' else os.path.splitext(path)[0] + '.csv'
+    writer = None
+    try:
+        for i, partition_path in enumerate(partition_paths):
+            table = pq.read_table(partition_path)
+            if file_format == 'parquet':
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            if file_format == 'csv' or export_csv:
+                table.to_pandas().to_csv(csv_path, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,156 @@
+# --- Header -------------------------------------------------------------------
+# Sensitivity sweep of the EM measures and country ranks over sample and metric thresholds
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import itertools
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from bootstrap import EM_METRICS, RANK_ASCENDING
+from do_analysis import (
+    ANALYSIS_COLUMNS, build_em_panel, calculate_aggregate, calculate_em1, calculate_em2, calculate_em3,
+    calculate_em4
+)
+from prepare_data import filter_countries, filter_firms
+from sharding import attach_panel, release_panel, share_panel
+from storage import read_table
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+# Panel rebuilt from shared memory once per worker process by the pool initializer
+_worker_panel = None
+_worker_shared_memory = []
+
+
+def main():
+    '''
+    Runs the EM pipeline for every combination of the thresholds in the sweep grid.
+
+    The pulled data is loaded, deduplicated and sorted once. Every grid point starts from
+    this panel, so the input file is never read again. The results are saved as one tidy
+    table with EM1-EM4, the ranks and the aggregate score per configuration and country.
+    '''
+    log.info("Running sensitivity sweep ...")
+    cfg = read_config('config/sweep_cfg.yaml')
+    prepare_cfg = read_config('config/prepare_data_cfg.yaml')
+    analysis_cfg = read_config('config/do_analysis_cfg.yaml')
+
+    # Thresholds that are not part of the grid keep their values from the prepare and analysis configs
+    defaults = {
+        'min_country_obs': prepare_cfg['min_country_obs'],
+        'min_consecutive_years': prepare_cfg['min_consecutive_years'],
+        'consecutive_years_rule': prepare_cfg['consecutive_years_rule'],
+        'em4_profit_band': analysis_cfg['em4_profit_band'],
+        'em4_min_small_losses': analysis_cfg['em4_min_small_losses'],
+        'year_range': None,
+    }
+    grid = expand_grid(cfg['grid'], defaults)
+    log.info(f"Sweeping {len(grid)} configurations with {cfg['workers']} workers")
+
+    panel = load_sweep_panel(prepare_cfg['worldscope_sample_save_path'], prepare_cfg['key_vars'])
+    results = run_sweep(panel, grid, prepare_cfg['key_vars'], cfg['workers'])
+
+    with open(cfg['sweep_results'], 'wb') as f:
+        pickle.dump({'sweep_results': results}, f)
+    log.info(f"Sweep results saved to {cfg['sweep_results']}")
+    log.info("Running sensitivity sweep ... Done!")
+
+
+def expand_grid(grid, defaults):
+    '''
+    Expands the parameter grid from the config into a list of parameter dicts.
+    '''
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {', '.join(sorted(unknown))}")
+    names = list(grid)
+    return [
+        {**defaults, **dict(zip(names, values))}
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def load_sweep_panel(data_path, key_vars):
+    '''
+    Loads the pulled data once, removes duplicate firm-years and sorts it by firm and year.
+    Only the columns needed for the filters and the EM measures are read.
+    '''
+    columns = ANALYSIS_COLUMNS + [var for var in key_vars if var not in ANALYSIS_COLUMNS]
+    df = read_table(data_path, columns=columns)
+    df = df.drop_duplicates(subset=['item6105', 'year_'], keep='first')
+    df['item6105'] = df['item6105'].astype('category')
+    return df.sort_values(['item6105', 'year_']).reset_index(drop=True)
+
+
+def run_grid_point(panel, params, key_vars):
+    '''
+    Runs the sample filters and the EM measures for one set of thresholds.
+
+    Returns the aggregate table with the per-metric ranks and the aggregate rank added.
+    '''
+    data = panel
+    if params['year_range'] is not None:
+        first_year, last_year = params['year_range']
+        data = data[(data['year_'] >= first_year) & (data['year_'] <= last_year)]
+    data, _, _ = filter_countries(data, key_vars, params['min_country_obs'])
+    data = filter_firms(data, key_vars, params['min_consecutive_years'], params['consecutive_years_rule'])
+
+    em_panel = build_em_panel(data)
+    country_em1, _ = calculate_em1(em_panel)
+    country_em2, _ = calculate_em2(em_panel)
+    country_em3, _ = calculate_em3(em_panel)
+    country_em4, _ = calculate_em4(em_panel, params['em4_profit_band'], params['em4_min_small_losses'])
+    return add_ranks(calculate_aggregate(country_em1, country_em2, country_em3, country_em4))
+
+
+def add_ranks(final_table):
+    '''
+    Adds the rank of every country in EM1-EM4 and in the aggregate score to the aggregate table.
+    '''
+    for metric in EM_METRICS:
+        final_table[f'Rank_{metric}'] = final_table[metric].rank(ascending=RANK_ASCENDING[metric])
+    final_table['Aggregate_Rank'] = final_table['Aggregate_EM_Score'].rank(ascending=False)
+    return final_table
+
+
+def _init_worker(layout):
+    global _worker_panel, _worker_shared_memory
+    _worker_panel, _worker_shared_memory = attach_panel(layout)
+
+
+def _run_worker_grid_point(params, key_vars):
+    return run_grid_point(_worker_panel, params, key_vars)
+
+
+def run_sweep(panel, grid, key_vars, workers=1):
+    '''
+    Runs all grid points and collects the results in one tidy table.
+
+    With workers > 1 the panel is placed in shared memory once and the grid points are
+    spread over a process pool. Each worker rebuilds the panel from the shared blocks.
+    '''
+    if workers > 1:
+        blocks, layout = share_panel(panel)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(layout,)) as pool:
+                tables = list(pool.map(_run_worker_grid_point, grid, [key_vars] * len(grid)))
+        finally:
+            release_panel(blocks)
+    else:
+        tables = [run_grid_point(panel, params, key_vars) for params in grid]
+
+    results = []
+    for params, table in zip(grid, tables):
+        settings = {name: value for name, value in params.items() if name != 'year_range'}
+        first_year, last_year = params['year_range'] if params['year_range'] is not None else (None, None)
+        settings.update({'first_year': first_year, 'last_year': last_year})
+        results.append(pd.concat([pd.DataFrame([settings] * len(table)), table], axis=1))
+    return pd.concat(results, ignore_index=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# --- Header -------------------------------------------------------------------
+# Seeded generator of synthetic Worldscope firm-year panels for benchmarks
+#
+# (C) Melisa Mazaeva -  See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+import argparse
+
+import numpy as np
+import pandas as pd
+from storage import apply_schema, storage_format
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+# Relative number of firms per country, roughly following the Worldscope coverage of the
+# 1990s. Countries that are not listed get a weight of one.
+COUNTRY_WEIGHTS = {
+    'UNITED STATES': 40, 'JAPAN': 20, 'UNITED KINGDOM': 12, 'GERMANY': 5, 'FRANCE': 5,
+    'CANADA': 4, 'KOREA (SOUTH)': 3, 'TAIWAN': 3, 'INDIA': 3, 'MALAYSIA': 3, 'AUSTRALIA': 3,
+    'HONG KONG': 2, 'ITALY': 2, 'SWITZERLAND': 2, 'SWEDEN': 2, 'SOUTH AFRICA': 2, 'THAILAND': 2,
+    'SPAIN': 2, 'NETHERLANDS': 2, 'SINGAPORE': 2,
+}
+
+# SIC codes that the synthetic firms are drawn from
+SIC_CODES = [1311, 1531, 2834, 2911, 3571, 3674, 3711, 4911, 5311, 6021, 7372, 8062]
+
+
+def main():
+    '''
+    Writes a synthetic panel with the columns of the pulled data to a parquet or csv file.
+    '''
+    parser = argparse.ArgumentParser(description='Generate a synthetic Worldscope firm-year panel.')
+    parser.add_argument('--rows', type=int, required=True, help='Number of firm-year rows.')
+    parser.add_argument('--seed', type=int, default=266, help='Seed of the random number generator.')
+    parser.add_argument('--output', required=True, help='Output file, the extension selects the storage format.')
+    args = parser.parse_args()
+
+    cfg = read_config('config/pull_data_cfg.yaml')
+    log.info(f"Generating {args.rows} synthetic firm-years ...")
+    write_panel(args.output, args.rows, seed=args.seed, countries=cfg['included_countries'])
+    log.info(f"Generating {args.rows} synthetic firm-years ... Done! Saved to {args.output}")
+
+
+def generate_chunk(rng, first_firm, n_firms, countries, first_year=1990, last_year=1999,
+                   gap_share=0.05, missing_debt_share=0.15, missing_taxes_share=0.2,
+                   missing_key_share=0.02, duplicate_share=0.005, max_rows=None):
+    '''
+    Generates the firm-years of n_firms consecutive synthetic firms.
+
+    Half of the firms are covered from first_year, the others enter later. Most firms are
+    covered until last_year. Single years are missing with probability gap_share. Short-term
+    debt and taxes payable are missing for a share of the firm-years, and every key item can
+    be missing. A share of the firm-years is repeated as duplicate rows, and the rows are
+    shuffled. All items are in the scale of the firm's total assets.
+
+    With max_rows, the firm-years of the last firms are left out so that the chunk has at
+    most max_rows rows including the duplicates.
+    '''
+    n_years = last_year - first_year + 1
+    start = np.where(rng.random(n_firms) < 0.5, first_year, first_year + rng.integers(0, n_years, n_firms))
+    end = np.where(rng.random(n_firms) < 0.8, last_year, start + rng.integers(0, n_years, n_firms))
+    end = np.minimum(end, last_year)
+    length = end - start + 1
+
+    # One row per firm and year, with the position of each row within its firm
+    firm = np.repeat(np.arange(n_firms), length)
+    firm_row = np.repeat(np.cumsum(length) - length, length)
+    position = np.arange(len(firm)) - firm_row
+    year = start[firm] + position
+
+    # Total assets follow a random walk in logs from a lognormal starting size
+    growth = rng.normal(0.05, 0.15, len(firm))
+    cumulative_growth = np.cumsum(growth)
+    cumulative_growth -= (cumulative_growth - growth)[firm_row]
+    total_assets = np.exp(rng.normal(5, 1.5, n_firms)[firm] + cumulative_growth)
+
+    # Leave out single years, which creates gaps in the firms' time series
+    keep = rng.random(len(firm)) >= gap_share
+    firm, year, total_assets = firm[keep], year[keep], total_assets[keep]
+    n = len(firm)
+    n_duplicates = int(round(duplicate_share * n))
+    if max_rows is not None and n + n_duplicates > max_rows:
+        n_duplicates = int(round(duplicate_share * max_rows / (1 + duplicate_share)))
+        n = max_rows - n_duplicates
+        firm, year, total_assets = firm[:n], year[:n], total_assets[:n]
+
+    operating_income = total_assets * rng.normal(0.06, 0.06, n)
+    data = {
+        'item6105': np.char.add('S', np.char.zfill((first_firm + np.arange(n_firms)).astype(str), 8))[firm],
+        'year_': year,
+        'item5350': fiscal_year_end(year),
+        'item2003': total_assets * rng.uniform(0.02, 0.2, n),
+        'item3051': np.where(rng.random(n) < missing_debt_share, np.nan, total_assets * rng.uniform(0, 0.1, n)),
+        'item3063': np.where(rng.random(n) < missing_taxes_share, np.nan, total_assets * rng.uniform(0, 0.03, n)),
+        'item1151': total_assets * rng.uniform(0.02, 0.06, n),
+        'item2999': total_assets,
+        'item1001': total_assets * rng.lognormal(0, 0.3, n),
+        'item1250': operating_income,
+        'item1651': 0.6 * operating_income + total_assets * rng.normal(0, 0.02, n),
+        'item3101': total_assets * rng.uniform(0.1, 0.4, n),
+        'item2201': total_assets * rng.uniform(0.25, 0.6, n),
+    }
+    for item in ['item2999', 'item1001', 'item1250', 'item1651']:
+        data[item][rng.random(n) < missing_key_share] = np.nan
+
+    # Static company data, drawn once per firm
+    weights = np.array([COUNTRY_WEIGHTS.get(country, 1) for country in countries], dtype=np.float64)
+    firm_country = rng.choice(len(countries), size=n_firms, p=weights / weights.sum())
+    data['item6001'] = np.char.add('SYNTHETIC FIRM ', (first_firm + np.arange(n_firms)).astype(str))[firm]
+    data['item6100'] = 'C'
+    data['item6026'] = pd.Categorical.from_codes(firm_country[firm], categories=countries)
+    data['item7021'] = np.array(SIC_CODES)[rng.integers(0, len(SIC_CODES), n_firms)][firm]
+    df = pd.DataFrame(data)
+
+    # Repeat some firm-years and shuffle the rows, as in the raw pull
+    duplicates = rng.integers(0, n, n_duplicates)
+    rows = rng.permutation(np.concatenate([np.arange(n), duplicates]))
+    return df.iloc[rows].reset_index(drop=True)
+
+
+def fiscal_year_end(year):
+    '''
+    Returns December 31 of each year as datetime64[ns].
+    '''
+    next_year = (np.asarray(year) - 1969).astype('datetime64[Y]').astype('datetime64[D]')
+    return (next_year - np.timedelta64(1, 'D')).astype('datetime64[ns]')
+
+
+def generate_panel(n_rows, seed=266, countries=None, chunk_firms=100_000, **options):
+    '''
+    Generates a synthetic panel of exactly n_rows firm-years as a sequence of chunks.
+
+    Every chunk covers at most chunk_firms new firms and gets its own seed spawned from the
+    base seed, so the panel only depends on n_rows, the seed and chunk_firms. The last chunk
+    is cut to n_rows. Options are passed on to generate_chunk.
+    '''
+    countries = sorted(countries if countries is not None else COUNTRY_WEIGHTS)
+    seed_sequence = np.random.SeedSequence(seed)
+    rows_left = n_rows
+    first_firm = 0
+    while rows_left > 0:
+        rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+        # Firms have about seven firm-years on average. One firm per four rows left leaves enough
+        # headroom for the chunk to reach the rows left, and max_rows cuts the firms beyond them
+        n_firms = min(chunk_firms, rows_left // 4 + 1)
+        chunk = generate_chunk(rng, first_firm, n_firms, countries, max_rows=rows_left, **options)
+        rows_left -= len(chunk)
+        first_firm += n_firms
+        yield chunk
+
+
+def write_panel(path, n_rows, seed=266, countries=None, chunk_firms=100_000, **options):
+    '''
+    Writes a synthetic panel to a parquet or csv file, one chunk at a time.
+
+    Only one chunk is held in memory, so panels larger than the memory can be written.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    file_format = storage_format(path)
+    writer = None
+    try:
+        for i, chunk in enumerate(generate_panel(n_rows, seed, countries, chunk_firms, **options)):
+            chunk = apply_schema(chunk)
+            if file_format == 'parquet':
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                chunk.to_csv(path, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+if __name__ == "__main__":
+    main()
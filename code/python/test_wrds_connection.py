@@ -1,6 +1,7 @@
 import os
 import dotenv
-import wrds
+from data_source import open_source
+from utils import read_config
 
 def load_wrds_credentials():
     '''
@@ -16,18 +17,19 @@ def load_wrds_credentials():
 
 def test_wrds_connection():
     '''
-    Test WRDS connection with credentials from secrets.env.
+    Test the connection to the data source selected in pull_data_cfg.yaml.
+    WRDS is reached with the credentials from secrets.env, the local database needs none.
+    Both tables of the pull are queried, so a missing table or schema is reported as well.
     '''
-    credentials = load_wrds_credentials()
-    db = wrds.Connection(
-        wrds_username=credentials['wrds_username'],
-        wrds_password=credentials['wrds_password']
-    )
-    print("Connection to WRDS successful!")
-    db.close()
+    cfg = read_config('config/pull_data_cfg.yaml')
+    credentials = load_wrds_credentials() if cfg['data_source'] == 'wrds' else None
+    with open_source(cfg, credentials) as source:
+        for table in ['wrds_ws_funda', 'wrds_ws_company']:
+            source.raw_sql(f"SELECT item6105 FROM tr_worldscope.{table} LIMIT 1")
+        print(f"Connection to {source.name} successful!")
 
 if __name__ == '__main__':
     try:
         test_wrds_connection()
     except Exception as e:
-        print(f"Error connecting to WRDS: {e}")
\ No newline at end of file
+        print(f"Error connecting to the data source: {e}")